@@ -150,13 +150,17 @@ document.addEventListener('DOMContentLoaded', function() {
                 const resp = await fetch(url, options);
                 // If 5xx, throw to retry
                 if (!resp.ok && resp.status >= 500) {
-                    throw new Error(`HTTP ${resp.status}`);
+                    const err = new Error(`HTTP ${resp.status}`);
+                    // Honor the server's hint when it is shedding load
+                    err.retryAfter = parseInt(resp.headers.get('Retry-After'), 10);
+                    throw err;
                 }
                 return resp;
             } catch (err) {
                 lastErr = err;
                 if (attempt < retries) {
-                    await new Promise(r => setTimeout(r, backoffMs * Math.pow(2, attempt)));
+                    const delay = err.retryAfter > 0 ? err.retryAfter * 1000 : backoffMs * Math.pow(2, attempt);
+                    await new Promise(r => setTimeout(r, delay));
                     continue;
                 }
             }
@@ -197,7 +201,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ url: url })
+                // Lite mode: basic metadata now, formats resolved in the background
+                body: JSON.stringify({ url: url, lite: true })
             }, 2, 1000);
 
             const data = await safeJsonParse(response);
@@ -205,11 +210,15 @@ document.addEventListener('DOMContentLoaded', function() {
             // Hide progress
             progressContainer.style.display = 'none';
             
-            // Show format options with real data
+            // Show format options with real data (defaults until formats arrive)
             displayQualityOptions(url, data);
             formatOptions.style.display = 'block';
             
-            showNotification('Video analyzed successfully!', 'success');
+            if (data.formats_pending && data.formats_url) {
+                loadFullAnalysis(url, data.formats_url);
+            } else {
+                showNotification('Video analyzed successfully!', 'success');
+            }
 
         } catch (error) {
             progressContainer.style.display = 'none';
@@ -225,6 +234,35 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Long-poll for the formats of a lite analysis and re-render the options
+    async function loadFullAnalysis(url, formatsUrl) {
+        for (let attempt = 0; attempt < 10; attempt++) {
+            try {
+                const resp = await fetchWithRetry(`${API_URL}${formatsUrl}?wait=20`, { method: 'GET' }, 1, 1000);
+                if (resp.status === 202) {
+                    // Still resolving (or the server is short of poll slots): back off as asked
+                    const retryAfter = parseInt(resp.headers.get('Retry-After'), 10) || 1;
+                    await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+                    continue;
+                }
+                const full = await safeJsonParse(resp);
+                // Ignore results for a URL the user has since replaced
+                if (videoUrlInput.value.trim() === url) {
+                    displayQualityOptions(url, full);
+                    showNotification('Video analyzed successfully!', 'success');
+                }
+                return;
+            } catch (err) {
+                // Keep the default quality options, but say why
+                console.warn('Could not load full format list:', err);
+                if (videoUrlInput.value.trim() === url) {
+                    showNotification(`Error: ${err.message || 'Could not load formats'}`, 'error');
+                }
+                return;
+            }
+        }
+    }
+
     // Function to validate URL
     function isValidUrl(string) {
         try {
@@ -290,14 +328,23 @@ document.addEventListener('DOMContentLoaded', function() {
             );
         }
 
-        // Add audio only option
+        // Add audio only options: original codec (no re-encode) and MP3
         qualities.push({ 
             label: 'Audio Only', 
             resolution: 'audio', 
-            size: 'MP3', 
+            audioFormat: 'original',
+            size: 'M4A / Opus', 
             icon: 'fa-music',
             videoData 
         });
+        qualities.push({ 
+            label: 'Audio (MP3)', 
+            resolution: 'audio', 
+            audioFormat: 'mp3',
+            size: 'MP3', 
+            icon: 'fa-headphones',
+            videoData 
+        });
 
         qualityGrid.innerHTML = '';
         
@@ -332,15 +379,98 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // Format helpers for live progress text
+    function formatBytes(bytes) {
+        if (!bytes) return '0 MB';
+        return `${(bytes / (1024 * 1024)).toFixed(1)} MB`;
+    }
+
+    function describeProgress(label, job) {
+        const p = job.progress || {};
+        if (job.status === 'queued' && job.queue) {
+            const wait = job.queue.estimated_wait;
+            return `Queued for ${label} (position ${job.queue.position})` +
+                (wait ? ` • starts in ~${Math.ceil(wait / 60)} min` : '');
+        }
+        if (job.status === 'postprocessing') {
+            return `Processing ${label}...`;
+        }
+        if (job.status !== 'downloading') {
+            return `Preparing ${label}...`;
+        }
+        const parts = [`Downloading ${label}`];
+        if (p.percent != null) parts.push(`${p.percent.toFixed(0)}%`);
+        if (p.total_bytes) {
+            parts.push(`${formatBytes(p.downloaded_bytes)} / ${formatBytes(p.total_bytes)}`);
+        }
+        if (p.speed) parts.push(`${formatBytes(p.speed)}/s`);
+        if (p.eta != null) parts.push(`ETA ${p.eta}s`);
+        if (p.fragment_count) parts.push(`fragment ${p.fragment_index}/${p.fragment_count}`);
+        return parts.join(' • ');
+    }
+
+    // Follow a download job until it finishes. Uses Server-Sent Events when
+    // available and falls back to polling the job status endpoint.
+    function waitForJob(jobId, label) {
+        return new Promise((resolve, reject) => {
+            const onUpdate = (job) => {
+                progressText.textContent = describeProgress(label, job);
+                const percent = job.progress && job.progress.percent;
+                if (percent != null) {
+                    progressFill.style.width = `${Math.max(5, percent)}%`;
+                }
+            };
+
+            const poll = async () => {
+                try {
+                    const resp = await fetchWithRetry(`${API_URL}/api/jobs/${jobId}`, { method: 'GET' }, 2, 1000);
+                    const job = await safeJsonParse(resp);
+                    if (job.status === 'finished') return resolve(job.result);
+                    if (job.status === 'error') return reject(new Error(job.error || 'Download failed'));
+                    onUpdate(job);
+                    setTimeout(poll, 1500);
+                } catch (err) {
+                    reject(err);
+                }
+            };
+
+            if (window.EventSource) {
+                const source = new EventSource(`${API_URL}/api/jobs/${jobId}/events`);
+                const handle = (e) => onUpdate(JSON.parse(e.data));
+                source.addEventListener('progress', handle);
+                source.addEventListener('postprocess', handle);
+                source.addEventListener('done', (e) => {
+                    source.close();
+                    resolve(JSON.parse(e.data).result);
+                });
+                source.addEventListener('error', (e) => {
+                    // Server-sent 'error' events carry data; connection errors
+                    // don't and EventSource reconnects on its own, unless the
+                    // server answered with an error status (e.g. 404 for an
+                    // expired job): then it gives up, and polling reports why.
+                    if (e.data) {
+                        source.close();
+                        reject(new Error(JSON.parse(e.data).error || 'Download failed'));
+                    } else if (source.readyState === EventSource.CLOSED) {
+                        poll();
+                    }
+                });
+                return;
+            }
+
+            poll();
+        });
+    }
+
     // Function to prepare download
     async function prepareDownload(quality, url, videoData) {
         formatOptions.style.display = 'none';
         progressContainer.style.display = 'block';
-        progressText.textContent = `Downloading ${quality.label}...`;
-        animateProgress(0, 30, 1000);
+        progressText.textContent = `Preparing ${quality.label}...`;
+        progressFill.style.width = '5%';
 
         try {
-            // Call backend API to download video
+            // Start the download as a background job on the backend
             const response = await fetchWithRetry(`${API_URL}/api/download`, {
                 method: 'POST',
                 headers: {
@@ -348,14 +478,21 @@ document.addEventListener('DOMContentLoaded', function() {
                 },
                 body: JSON.stringify({ 
                     url: url,
-                    quality: quality.resolution
+                    quality: quality.resolution,
+                    audio_format: quality.audioFormat || 'original',
+                    async: true
                 })
             }, 2, 1500);
 
-            animateProgress(30, 70, 2000);
-            const data = await safeJsonParse(response);
+            const job = await safeJsonParse(response);
+            if (job.queue) {
+                progressText.textContent = describeProgress(quality.label, job);
+            }
+            const data = job.job_id && !job.filename
+                ? await waitForJob(job.job_id, quality.label)
+                : job;
 
-            animateProgress(70, 100, 1000);
+            progressFill.style.width = '100%';
 
             setTimeout(() => {
                 progressContainer.style.display = 'none';
@@ -365,7 +502,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 result.style.display = 'block';
                 
                 showNotification('Download complete!', 'success');
-            }, 1000);
+            }, 500);
 
         } catch (error) {
             progressContainer.style.display = 'none';
@@ -529,7 +666,7 @@ IMPORTANT NOTES FOR PRODUCTION:
 2. Backend API Endpoints Needed:
    - POST /api/analyze - Analyze video URL and return metadata
    - POST /api/download - Process and download video
-   - GET /api/progress/:id - Check download progress
+   - GET /api/jobs/:id/events - Live download progress (SSE)
 
 3. Legal Considerations:
    - Respect copyright laws
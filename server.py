@@ -1,17 +1,37 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory, abort
+from flask import Flask, Response, g, request, jsonify, redirect, send_file, send_from_directory, abort
 from flask_cors import CORS
 import yt_dlp
 import os
+import html
 import json
+import mimetypes
 import re
 import logging
-from urllib.parse import urlparse, quote
+from urllib.parse import urlparse, urlencode, parse_qsl, quote, urljoin
 import concurrent.futures
+import copy
 from pathlib import Path
 from datetime import datetime
 import hashlib
+import ipaddress
+import shutil
+import socket
+import subprocess
+import math
 import time
-from collections import deque
+import threading
+import uuid
+import bisect
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:  # fall back to the system resolver with a fixed TTL
+    dns = None
 
 # Configure logging
 logging.basicConfig(
@@ -24,164 +44,3039 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__, static_folder='.')
+app = Flask(__name__, static_folder='.')
+
+# CORS configuration with more security (allow GH Pages, Render, and local dev)
+CORS(app, resources={
+    r"/api/*": {
+        # Use regex patterns for origins to properly match ports/subdomains
+        "origins": [
+            r"https?://localhost(:\d+)?",
+            r"https?://127\.0\.0\.1(:\d+)?",
+            r"https://iwtbg-8\.github\.io",
+            r"https://.*\.onrender\.com"
+        ],
+        "methods": ["GET", "POST", "OPTIONS"],
+        "allow_headers": ["Content-Type"],
+        "expose_headers": ["Retry-After", "Age", "X-Cache"]
+    }
+})
+
+# Configuration
+MAX_FILESIZE = 20 * 1024 * 1024 * 1024  # 20GB max file size
+ALLOWED_DOMAINS = []  # Empty means all domains allowed
+DOWNLOAD_DIR = os.environ.get('DOWNLOAD_DIR') or os.path.join(os.getcwd(), 'downloads')
+CACHE_TTL = 24 * 3600  # 24 hours cache (increased); entries are fresh this long
+CACHE_HARD_TTL = 3 * 24 * 3600  # stale entries are served (and revalidated) until this age
+CACHE_REVALIDATE_RATE = 0.5  # background refreshes per second
+CACHE_REVALIDATE_BURST = 5
+CACHE_REVALIDATE_WORKERS = 2
+RATE_LIMIT_WINDOW = 10 * 60  # 10 minutes window (for 1000 requests)
+RATE_LIMIT_MAX = 1000  # Max 1000 requests per IP per 10 minutes (very generous)
+WAITRESS_THREADS = int(os.environ.get('WAITRESS_THREADS', 24))  # worker threads in production
+
+# Timeouts
+ANALYZE_TIMEOUT = 30  # seconds timeout for yt-dlp extract_info calls
+
+# DNS cache used for SSRF validation
+DNS_CACHE_SIZE = 1024  # hostnames kept (LRU)
+DNS_MIN_TTL = 5
+DNS_MAX_TTL = 300
+DNS_DEFAULT_TTL = 60  # used when the record TTL is unknown (system resolver)
+DNS_NEGATIVE_TTL = 30  # cache failed lookups this long
+DNS_TIMEOUT = 5
+BLOCKED_NETWORKS = tuple(ipaddress.ip_network(n) for n in (
+    '0.0.0.0/8',        # "this" network
+    '10.0.0.0/8',       # RFC1918
+    '100.64.0.0/10',    # carrier-grade NAT
+    '127.0.0.0/8',      # loopback
+    '169.254.0.0/16',   # link-local (incl. cloud metadata)
+    '172.16.0.0/12',    # RFC1918
+    '192.0.0.0/24',     # IETF protocol assignments
+    '192.168.0.0/16',   # RFC1918
+    '198.18.0.0/15',    # benchmarking
+    '224.0.0.0/4',      # multicast
+    '240.0.0.0/4',      # reserved, broadcast
+    '::/128',           # unspecified
+    '::1/128',          # loopback
+    '64:ff9b:1::/48',   # local-use NAT64
+    'fc00::/7',         # unique local (ULA)
+    'fe80::/10',        # link-local
+    'ff00::/8',         # multicast
+))
+
+# Two-phase ("lite") analyze: page metadata first, formats in the background
+LITE_FETCH_TIMEOUT = 5  # seconds for the metadata page fetch
+LITE_MAX_BYTES = 2 * 1024 * 1024  # stop reading the page after this much HTML
+LITE_MAX_REDIRECTS = 3  # redirects followed (each hop revalidated) for the metadata page
+ANALYZE_WORKERS = 4  # background full analyses started by lite requests
+ANALYZE_MAX_PENDING = ANALYZE_WORKERS * 4  # running + queued; lite requests beyond get 503
+ANALYZE_POLL_MAX_WAIT = 25  # longest ?wait= a formats poll may block
+ANALYZE_MAX_LONG_POLLS = max(1, WAITRESS_THREADS // 4)  # each blocked poll holds a worker thread
+ANALYZE_RESULT_RETENTION = 10 * 60  # keep finished background analyses pollable
+
+# Cluster mode: shard videos across nodes by consistent hashing (off unless configured)
+CLUSTER_NODES = [n for n in os.environ.get('CLUSTER_NODES', '').split(',') if n.strip()]  # base URLs
+CLUSTER_SELF = os.environ.get('CLUSTER_SELF', '')  # this node's base URL, as listed
+CLUSTER_CONFIG = os.environ.get('CLUSTER_CONFIG', '')  # JSON file {"nodes": [...], "self": "..."}
+CLUSTER_VNODES = 128  # virtual nodes per node on the hash ring
+CLUSTER_FORWARD_TIMEOUT = ANALYZE_TIMEOUT + 15  # wait for an owner's extraction
+CLUSTER_RETRY_AFTER = 10  # suggested to clients when the owner answers too slowly
+CLUSTER_COPY_TTL = 5 * 60  # non-owners serve forwarded metadata locally this long
+CLUSTER_HEADER = 'X-Cluster-Forwarded'  # set on forwarded requests; never forwarded again
+
+# Negative cache for failed extractions, keyed by video identity
+NEGATIVE_CACHE_PERMANENT_TTL = 10 * 60  # private, removed, geo-blocked, unsupported
+NEGATIVE_CACHE_TRANSIENT_TTL = 30  # timeouts, anti-bot challenges, upstream 5xx
+NEGATIVE_CACHE_SIZE = 2048  # entries kept (LRU)
+
+# Pooled yt-dlp instances
+YDL_POOL_SIZE = 4  # idle instances kept per option profile
+YDL_MAX_USES = 50  # recycle an instance after this many checkouts
+YDL_MAX_AGE = 30 * 60  # ... or after this many seconds
+EXTRACT_WORKERS = 8  # threads running timed extract_info calls
+
+# Adaptive concurrency limits for /api/* (AIMD on observed latency)
+CONCURRENCY_BUDGETS = {
+    # budget -> (initial limit, min limit, max limit, latency target in seconds)
+    'cheap': (16, 4, 64, 1.0),  # /api, job status, metrics, cache hits
+    'expensive': (4, 1, EXTRACT_WORKERS, ANALYZE_TIMEOUT / 2),  # extraction, downloads
+}
+CONCURRENCY_BACKOFF = 0.9  # multiplicative decrease on an overload signal
+CONCURRENCY_DECREASE_INTERVAL = 1.0  # at most one decrease per budget per second
+CONCURRENCY_RETRY_AFTER = 2  # seconds suggested to rejected clients
+
+# Download jobs and live progress (Server-Sent Events)
+DOWNLOAD_WORKERS = 4  # background threads running async download jobs
+JOB_RETENTION = 3600  # keep finished jobs queryable for 1 hour
+PROGRESS_MIN_INTERVAL = 0.25  # coalesce progress hooks to at most 4 events/s
+SSE_HEARTBEAT_INTERVAL = 10  # seconds between keep-alive comments
+SSE_STREAM_WINDOW = 30  # max seconds of one SSE response (clients then reconnect)
+SSE_RETRY_MS = 1000  # client reconnect delay between stream windows
+# Each open stream owns a Waitress thread (clients reconnect straight after a
+# window ends), so cap streams well below the pool to keep API requests served
+SSE_MAX_STREAMS = max(1, WAITRESS_THREADS // 4)  # then fall back to snapshots
+
+# Progressive serving of downloads that are still being written
+PROGRESSIVE_MAX_READERS = 8  # concurrent tailing responses (each holds a worker thread)
+PROGRESSIVE_CHUNK_SIZE = 256 * 1024
+PROGRESSIVE_START_TIMEOUT = 10  # how long a reader waits for a queued job to pick its format
+PROGRESSIVE_STALL_TIMEOUT = 120  # end a tail when the writer makes no progress this long
+
+# Durable job journal and graceful shutdown
+JOB_JOURNAL_PATH = os.path.join('.state', 'jobs.jsonl')  # under DOWNLOAD_DIR, unreachable via download_file
+SHUTDOWN_DRAIN_TIMEOUT = int(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', 25))  # Render kills 30s after SIGTERM
+SHUTDOWN_RETRY_AFTER = 15  # seconds suggested to clients turned away while draining
+
+# Download admission control
+MAX_CONCURRENT_DOWNLOADS = DOWNLOAD_WORKERS  # global cap on running downloads
+MAX_DOWNLOADS_PER_CLIENT = 2  # running downloads per client IP
+MAX_QUEUED_PER_CLIENT = 10  # queued downloads per client IP before 429
+DOWNLOAD_DURATION_ESTIMATE = 60  # initial guess (s) for queue ETAs, refined as jobs finish
+DISK_SPACE_MARGIN = 1024 * 1024 * 1024  # always leave 1GB free in DOWNLOAD_DIR
+
+# Egress shaping for served files (bytes per second, 0 = unlimited)
+EGRESS_GLOBAL_RATE = 50 * 1024 * 1024  # all bulk file transfers combined
+EGRESS_CLIENT_RATE = 10 * 1024 * 1024  # per client IP
+EGRESS_BURST_SECONDS = 1.0  # bucket capacity, in seconds of rate
+EGRESS_BYPASS_SIZE = 2 * 1024 * 1024  # smaller files use the interactive lane
+THROUGHPUT_WINDOW = 10  # seconds of history behind reported rates
+
+# Segmented range downloading for progressive (single-URL) formats
+SEGMENTED_DOWNLOADS = True
+SEGMENTED_MIN_FILESIZE = 8 * 1024 * 1024  # smaller files go straight to yt-dlp
+SEGMENT_INITIAL_SIZE = 2 * 1024 * 1024
+SEGMENT_MIN_SIZE = 512 * 1024
+SEGMENT_MAX_SIZE = 32 * 1024 * 1024
+SEGMENT_TARGET_SECONDS = 2.0  # size segments so one takes about this long
+SEGMENT_MIN_CONNECTIONS = 2
+SEGMENT_INITIAL_CONNECTIONS = 4
+SEGMENT_MAX_CONNECTIONS = 8
+SEGMENT_ADAPT_INTERVAL = 2.0  # seconds between parallelism adjustments
+SEGMENT_RETRIES = 5
+
+# Direct-URL delivery (browser fetches the media URL itself)
+DELIVERY_MODES = ('proxy', 'direct', 'redirect')
+DIRECT_URL_DEFAULT_TTL = 5 * 60  # cache lifetime when the URL has no expire= parameter
+DIRECT_URL_EXPIRY_MARGIN = 60  # stop handing out URLs this close to their expiry
+
+# Audio delivery: stream-copy by default, transcode only on explicit request
+AUDIO_FORMATS = {
+    # audio_format -> (yt-dlp selector, source codec prefix, container ext, ffmpeg encoder)
+    'original': ('bestaudio/best', None, None, None),
+    'm4a': ('bestaudio[ext=m4a]/bestaudio/best', 'mp4a', 'm4a', 'aac'),
+    'opus': ('bestaudio[acodec=opus]/bestaudio/best', 'opus', 'opus', 'libopus'),
+    'mp3': ('bestaudio[acodec=mp3]/bestaudio/best', 'mp3', 'mp3', 'libmp3lame'),
+}
+AUDIO_TRANSCODE_BITRATE = '192k'
+AUDIO_TRANSCODE_WORKERS = os.cpu_count() or 2  # one single-threaded ffmpeg per core
+AUDIO_TRANSCODE_TIMEOUT = 30 * 60
+
+# In-memory caches and rate limit storage
+analyze_cache = {}  # url -> (timestamp, data)
+formats_cache = {}  # url -> (timestamp, data)
+rate_limit_map = {}  # ip -> deque[timestamps]
+download_jobs = {}  # job_id -> DownloadJob
+download_jobs_lock = threading.Lock()
+active_downloads = {}  # (video key, quality, audio_format) -> DownloadJob, shared by identical requests
+progressive_reader_slots = threading.BoundedSemaphore(PROGRESSIVE_MAX_READERS)
+shutdown_event = threading.Event()  # set once a graceful shutdown starts draining
+download_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download')
+sse_stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+extract_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=EXTRACT_WORKERS, thread_name_prefix='extract')
+transcode_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=AUDIO_TRANSCODE_WORKERS, thread_name_prefix='transcode')
+transcode_jobs = {}  # output path -> Future of the latest transcode
+analyze_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=ANALYZE_WORKERS, thread_name_prefix='analyze')
+pending_analyses = {}  # analysis_id -> PendingAnalysis
+pending_analyses_lock = threading.Lock()
+analysis_poll_slots = threading.BoundedSemaphore(ANALYZE_MAX_LONG_POLLS)
+direct_url_cache = {}  # (video key, quality, audio_format) -> (valid_until, resolution)
+transcode_lock = threading.Lock()
+
+# Create downloads directory if it doesn't exist
+if not os.path.exists(DOWNLOAD_DIR):
+    os.makedirs(DOWNLOAD_DIR)
+    logger.info(f"Created download directory: {DOWNLOAD_DIR}")
+
+# ============================================================================
+# DNS RESOLUTION & SSRF PROTECTION
+# ============================================================================
+
+_system_getaddrinfo = socket.getaddrinfo
+
+
+def _is_blocked_address(address):
+    """True if ``address`` is in a private, loopback or otherwise internal range."""
+    ip = ipaddress.ip_address(address.split('%', 1)[0])  # drop IPv6 zone id
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return any(ip in net for net in BLOCKED_NETWORKS)
+
+
+def _lookup_host(hostname):
+    """Resolve ``hostname`` to ``(addresses, ttl)`` without caching."""
+    if dns is not None:
+        addresses, ttl = [], DNS_MAX_TTL
+        for rdtype in ('A', 'AAAA'):
+            try:
+                answer = dns.resolver.resolve(hostname, rdtype, lifetime=DNS_TIMEOUT)
+            except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                continue
+            except dns.exception.DNSException as e:
+                raise socket.gaierror(f"DNS lookup failed for {hostname}: {e}")
+            addresses.extend(r.address for r in answer)
+            ttl = min(ttl, answer.rrset.ttl)
+        if not addresses:
+            raise socket.gaierror(f"No addresses for {hostname}")
+        return addresses, ttl
+
+    infos = _system_getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP)
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    return addresses, DNS_DEFAULT_TTL
+
+
+class DNSCache:
+    """TTL-respecting, size-bounded DNS cache with single-flight lookups.
+
+    Concurrent requests for the same uncached hostname share one lookup.
+    Record TTLs are clamped to [DNS_MIN_TTL, DNS_MAX_TTL]; failed lookups
+    are cached for DNS_NEGATIVE_TTL.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # hostname -> (expires, addresses)
+        self.inflight = {}  # hostname -> threading.Event
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, hostname):
+        """Return the cached or freshly resolved addresses (``[]`` on failure)."""
+        hostname = hostname.lower().rstrip('.')
+        while True:
+            with self.lock:
+                entry = self.entries.get(hostname)
+                if entry and entry[0] > time.monotonic():
+                    self.entries.move_to_end(hostname)
+                    self.hits += 1
+                    return entry[1]
+                event = self.inflight.get(hostname)
+                leader = event is None
+                if leader:
+                    event = self.inflight[hostname] = threading.Event()
+                    self.misses += 1
+            if leader:
+                break
+            # Another thread is resolving this name; use its result
+            event.wait(DNS_TIMEOUT * 2)
+
+        try:
+            addresses, ttl = _lookup_host(hostname)
+            ttl = min(DNS_MAX_TTL, max(DNS_MIN_TTL, ttl))
+        except (socket.gaierror, UnicodeError) as e:
+            logger.warning(f"DNS lookup failed for {hostname}: {e}")
+            addresses, ttl = [], DNS_NEGATIVE_TTL
+        with self.lock:
+            self.entries[hostname] = (time.monotonic() + ttl, addresses)
+            self.entries.move_to_end(hostname)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            del self.inflight[hostname]
+        event.set()
+        return addresses
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+dns_cache = DNSCache(DNS_CACHE_SIZE)
+dns_pins = {}  # hostname -> [validated addresses, active pin count]
+dns_pins_lock = threading.Lock()
+
+
+def resolve_public_host(hostname):
+    """Return the addresses of ``hostname`` if all of them are public, else None."""
+    try:
+        addresses = [str(ipaddress.ip_address(hostname))]  # IP literal
+    except ValueError:
+        addresses = dns_cache.resolve(hostname)
+    if not addresses:
+        return None
+    blocked = [a for a in addresses if _is_blocked_address(a)]
+    if blocked:
+        logger.warning(f"Blocked internal address for {hostname}: {', '.join(blocked)}")
+        return None
+    return addresses
+
+
+def _pinned_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    """socket.getaddrinfo that answers pinned hostnames from their validated addresses."""
+    if isinstance(host, str):
+        with dns_pins_lock:
+            pin = dns_pins.get(host.lower().rstrip('.'))
+            addresses = list(pin[0]) if pin else None
+        if addresses:
+            results = []
+            for address in addresses:
+                try:
+                    results.extend(_system_getaddrinfo(address, port, family, type, proto,
+                                                       flags | socket.AI_NUMERICHOST))
+                except socket.gaierror:
+                    continue  # address family not wanted by the caller
+            if results:
+                return results
+            raise socket.gaierror(socket.EAI_NONAME, f"No usable pinned address for {host}")
+    return _system_getaddrinfo(host, port, family, type, proto, flags)
+
+
+socket.getaddrinfo = _pinned_getaddrinfo
+
+
+@contextmanager
+def pin_url_host(url):
+    """Pin the validated addresses of ``url``'s host for the enclosed fetches.
+
+    While pinned, every connection to that hostname (from yt-dlp or the
+    segmented downloader, in any thread) uses exactly the addresses that
+    passed validation, so a DNS answer that changes between validation and
+    fetch can't redirect the request to an internal address.
+    """
+    hostname = (urlparse(url).hostname or '').lower().rstrip('.')
+    addresses = resolve_public_host(hostname) if hostname else None
+    if not addresses:
+        raise DownloadJobError('Invalid URL format', 400)
+    with dns_pins_lock:
+        pin = dns_pins.get(hostname)
+        if pin:
+            pin[0], pin[1] = addresses, pin[1] + 1
+        else:
+            dns_pins[hostname] = [addresses, 1]
+    try:
+        yield addresses
+    finally:
+        with dns_pins_lock:
+            pin = dns_pins[hostname]
+            pin[1] -= 1
+            if not pin[1]:
+                del dns_pins[hostname]
+
+# ============================================================================
+# UTILITY FUNCTIONS
+# ============================================================================
+
+def is_valid_url(url):
+    """Validate URL format and check for suspicious patterns"""
+    try:
+        result = urlparse(url)
+        
+        # Check basic URL structure
+        if not all([result.scheme, result.netloc]):
+            return False
+        
+        # Only allow http and https
+        if result.scheme not in ['http', 'https']:
+            return False
+        
+        # Resolve the host and block private/internal addresses to prevent SSRF
+        if not result.hostname or resolve_public_host(result.hostname) is None:
+            logger.warning(f"Blocked URL host: {result.netloc}")
+            return False
+        
+        return True
+    except Exception as e:
+        logger.error(f"URL validation error: {e}")
+        return False
+
+def sanitize_text(text):
+    """Sanitize text to prevent XSS and other injection attacks"""
+    if not text:
+        return ""
+    
+    # Remove potentially dangerous characters
+    text = str(text)
+    text = re.sub(r'[<>"\']', '', text)
+    text = text.strip()
+    
+    return text[:500]  # Limit length
+
+def sanitize_filename(filename):
+    """Sanitize filename to prevent directory traversal and ensure safety"""
+    # Remove any directory components
+    filename = os.path.basename(filename)
+    
+    # Remove any dangerous characters
+    filename = re.sub(r'[^\w\s\-\.]', '', filename)
+    
+    # Limit length
+    if len(filename) > 255:
+        name, ext = os.path.splitext(filename)
+        filename = name[:250] + ext
+    
+    return filename
+
+def get_client_ip():
+    """Get client IP considering proxies (X-Forwarded-For)."""
+    xff = request.headers.get('X-Forwarded-For', '')
+    if xff:
+        # Take the first IP in the list
+        return xff.split(',')[0].strip()
+    return request.remote_addr or 'unknown'
+
+def is_rate_limited(ip):
+    """Basic fixed-window rate limiter using a sliding deque."""
+    now = time.time()
+    dq = rate_limit_map.get(ip)
+    if dq is None:
+        dq = deque()
+        rate_limit_map[ip] = dq
+    # Evict old timestamps
+    while dq and now - dq[0] > RATE_LIMIT_WINDOW:
+        dq.popleft()
+    if len(dq) >= RATE_LIMIT_MAX:
+        return True
+    dq.append(now)
+    return False
+
+
+# ============================================================================
+# VIDEO IDENTITY & NEGATIVE CACHE
+# ============================================================================
+
+YOUTUBE_HOSTS = ('youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtube-nocookie.com')
+YOUTUBE_ID_RE = re.compile(r'^[\w-]{11}$')
+TRACKING_PARAMS = ('si', 'feature', 'pp', 'fbclid', 'gclid')
+
+def canonical_video_key(url):
+    """Stable identity for a video URL, e.g. 'youtube:dQw4w9WgXcQ'.
+
+    YouTube watch, short, embed and youtu.be links collapse to the video ID;
+    other URLs are normalized (host case, www., fragment, tracking params).
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    path = parsed.path.rstrip('/') or '/'
+    if host in YOUTUBE_HOSTS or host == 'youtu.be':
+        video_id = None
+        if host == 'youtu.be':
+            video_id = path.lstrip('/').split('/')[0]
+        elif path == '/watch':
+            video_id = dict(parse_qsl(parsed.query)).get('v')
+        else:
+            parts = path.lstrip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v'):
+                video_id = parts[1]
+        if video_id and YOUTUBE_ID_RE.match(video_id):
+            return f"youtube:{video_id}"
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+                   if not k.startswith('utm_') and k not in TRACKING_PARAMS)
+    netloc = host + (f":{parsed.port}" if parsed.port else '')
+    key = f"{parsed.scheme.lower()}://{netloc}{path}"
+    return f"{key}?{urlencode(query)}" if query else key
+
+# Lowercased message fragments. A definitive "gone" status wins; otherwise
+# transient markers are checked first (anti-bot pages often look permanent)
+GONE_ERROR_MARKERS = ('http error 404', 'http error 410')
+TRANSIENT_ERROR_MARKERS = (
+    'not a bot', 'timed out', 'timeout', 'temporarily', 'try again later',
+    'http error 429', 'http error 5', 'connection', 'unable to download webpage',
+)
+PERMANENT_ERROR_MARKERS = (
+    'private video', 'video unavailable', 'video is unavailable', 'has been removed',
+    'no longer available', 'not available in your country', 'geo restrict',
+    'account associated with this video has been terminated', 'copyright',
+    'unsupported url', 'does not exist',
+)
+
+def classify_extraction_error(error):
+    """Return 'permanent' or 'transient' for a failed extraction."""
+    if isinstance(error, (TimeoutError, concurrent.futures.TimeoutError)):
+        return 'transient'
+    msg = str(error).lower()
+    # "Unable to download webpage: HTTP Error 404" is a removed page, not a blip
+    if any(marker in msg for marker in GONE_ERROR_MARKERS):
+        return 'permanent'
+    if any(marker in msg for marker in TRANSIENT_ERROR_MARKERS):
+        return 'transient'
+    if any(marker in msg for marker in PERMANENT_ERROR_MARKERS):
+        return 'permanent'
+    # Unknown failures get the short TTL so a real fix is picked up quickly
+    return 'transient'
+
+class NegativeCache:
+    """Short-lived LRU of failed extractions so repeats skip upstream work."""
+
+    TTLS = {
+        'permanent': NEGATIVE_CACHE_PERMANENT_TTL,
+        'transient': NEGATIVE_CACHE_TRANSIENT_TTL,
+    }
+
+    def __init__(self, max_entries=NEGATIVE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (scope, video key) -> entry dict
+        self._lock = threading.Lock()
+        self.hits = {kind: 0 for kind in self.TTLS}
+        self.stores = {kind: 0 for kind in self.TTLS}
+
+    def get(self, scope, key):
+        """Return (payload, status, kind, retry_after) for a live entry, else None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((scope, key))
+            if entry is None:
+                return None
+            if entry['expires'] <= now:
+                del self._entries[(scope, key)]
+                return None
+            entry['hits'] += 1
+            self.hits[entry['kind']] += 1
+            self._entries.move_to_end((scope, key))
+            return entry['payload'], entry['status'], entry['kind'], max(1, int(entry['expires'] - now))
+
+    def peek(self, scope, key):
+        """Whether a live entry exists, without counting a hit."""
+        with self._lock:
+            entry = self._entries.get((scope, key))
+            return entry is not None and entry['expires'] > time.time()
+
+    def put(self, scope, key, kind, payload, status):
+        with self._lock:
+            self._entries[(scope, key)] = {
+                'kind': kind,
+                'payload': payload,
+                'status': status,
+                'expires': time.time() + self.TTLS[kind],
+                'hits': 0,
+            }
+            self._entries.move_to_end((scope, key))
+            self.stores[kind] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            live = [(k, e) for k, e in self._entries.items() if e['expires'] > now]
+            top = sorted(live, key=lambda item: item[1]['hits'], reverse=True)[:20]
+            return {
+                'entries': len(live),
+                'hits': dict(self.hits),
+                'stores': dict(self.stores),
+                # Which videos failed is not published (/api/metrics is public)
+                'top': [{
+                    'scope': scope,
+                    'kind': entry['kind'],
+                    'status': entry['status'],
+                    'hits': entry['hits'],
+                    'expires_in': round(entry['expires'] - now, 1),
+                } for (scope, _), entry in top],
+            }
+
+negative_cache = NegativeCache()
+
+def cached_failure_response(scope, key):
+    """Replay a cached extraction failure, or None if there is none."""
+    hit = negative_cache.get(scope, key)
+    if hit is None:
+        return None
+    payload, status, kind, retry_after = hit
+    logger.info(f"Returning cached {kind} failure for {key} ({scope})")
+    response = jsonify(payload)
+    response.status_code = status
+    response.headers['X-Negative-Cache'] = kind
+    if kind == 'transient':
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def record_failure(scope, key, error, payload, status):
+    """Cache an extraction failure and return ``(payload, status)``."""
+    kind = classify_extraction_error(error)
+    negative_cache.put(scope, key, kind, payload, status)
+    return payload, status
+
+def remember_failure(scope, key, error, payload, status):
+    """Cache an extraction failure and return the (response, status) tuple."""
+    payload, status = record_failure(scope, key, error, payload, status)
+    return jsonify(payload), status
+
+
+# ============================================================================
+# YT-DLP OPTION PROFILES & INSTANCE POOLS
+# ============================================================================
+
+# Shared by all profiles: browser-like headers to bypass restrictions
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+YOUTUBE_EXTRACTOR_ARGS = {
+    'youtube': {
+        'player_client': ['android', 'web'],
+        'skip': ['hls', 'dash', 'translated_subs']
+    }
+}
+
+_DOWNLOAD_OPTS = {
+    'quiet': False,
+    'no_warnings': True,
+    'socket_timeout': 120,
+    'retries': 10,
+    'fragment_retries': 10,
+    'concurrent_fragment_downloads': 10,
+    'user_agent': USER_AGENT,
+    'referer': 'https://www.youtube.com/',
+    'nocheckcertificate': True,
+    'outtmpl': os.path.join(DOWNLOAD_DIR, '%(title).100s.%(ext)s'),  # set per checkout
+    'restrictfilenames': True,
+    'extractor_args': YOUTUBE_EXTRACTOR_ARGS,
+    'http_headers': {
+        'User-Agent': USER_AGENT,
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-us,en;q=0.5',
+        'Accept-Encoding': 'gzip, deflate',
+        'Sec-Fetch-Mode': 'navigate',
+    },
+    'noplaylist': True,
+    'geo_bypass': True,
+    'sleep_interval': 2,
+    'max_sleep_interval': 5,
+}
+
+YDL_PROFILES = {
+    # yt-dlp options for extracting info only with proper headers
+    'analyze': {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': False,
+        'socket_timeout': 60,
+        'user_agent': USER_AGENT,
+        'referer': 'https://www.youtube.com/',
+        'nocheckcertificate': True,
+        'extractor_args': YOUTUBE_EXTRACTOR_ARGS,
+        'http_headers': {
+            'User-Agent': USER_AGENT,
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-US,en;q=0.9',
+            'Accept-Encoding': 'gzip, deflate',
+            'DNT': '1',
+        },
+        'noplaylist': True,
+        'geo_bypass': True,
+        'sleep_interval': 2,
+        'max_sleep_interval': 5,
+    },
+    'formats': {
+        'quiet': True,
+        'no_warnings': True,
+        'socket_timeout': 60,
+        'user_agent': USER_AGENT,
+        'referer': 'https://www.youtube.com/',
+        'nocheckcertificate': True,
+        'extractor_args': YOUTUBE_EXTRACTOR_ARGS,
+        'http_headers': {
+            'User-Agent': USER_AGENT,
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-US,en;q=0.9',
+            'Accept-Encoding': 'gzip, deflate',
+        },
+        'noplaylist': True,
+        'geo_bypass': True,
+        'sleep_interval': 1,
+        'max_sleep_interval': 3,
+    },
+    'download-video': {
+        **_DOWNLOAD_OPTS,
+        'format': 'best[height<=720]',  # set per checkout
+        'merge_output_format': 'mp4',
+    },
+    'download-audio': {
+        **_DOWNLOAD_OPTS,
+        'format': AUDIO_FORMATS['original'][0],  # set per checkout
+    },
+}
+
+
+class _PooledYDL:
+    """A pooled YoutubeDL plus the per-checkout hooks it relays to."""
+
+    def __init__(self, opts):
+        # YoutubeDL keeps (and mutates) the params dict it is given
+        self.ydl = yt_dlp.YoutubeDL(copy.deepcopy(opts))
+        self.created_at = time.time()
+        self.uses = 0
+        self.progress_hook = None
+        self.postprocessor_hook = None
+        self.ydl.add_progress_hook(lambda d: self.progress_hook and self.progress_hook(d))
+        self.ydl.add_postprocessor_hook(lambda d: self.postprocessor_hook and self.postprocessor_hook(d))
+
+    @property
+    def expired(self):
+        return self.uses >= YDL_MAX_USES or time.time() - self.created_at >= YDL_MAX_AGE
+
+
+class YoutubeDLPool:
+    """Thread-safe pool of reusable YoutubeDL instances for one option profile.
+
+    Building a YoutubeDL sets up extractors, the cookie jar and HTTP
+    handlers; reusing instances keeps those (and keep-alive connections and
+    extractor caches) across requests. Each checkout has exclusive use of
+    its instance. When the pool is empty an extra instance is created, and
+    instances are recycled after YDL_MAX_USES checkouts or YDL_MAX_AGE.
+    """
+
+    def __init__(self, name, opts, size=YDL_POOL_SIZE):
+        self.name = name
+        self.opts = opts
+        self.size = size
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _new(self):
+        with self.lock:
+            self.created += 1
+        return _PooledYDL(self.opts)
+
+    def warm(self):
+        """Pre-create idle instances up to the pool size."""
+        while True:
+            with self.lock:
+                if len(self.idle) >= self.size:
+                    return
+            entry = self._new()
+            with self.lock:
+                self.idle.append(entry)
+
+    def _acquire(self):
+        with self.lock:
+            while self.idle:
+                entry = self.idle.popleft()
+                if not entry.expired:
+                    self.reused += 1
+                    return entry
+                self._close(entry)
+        return self._new()
+
+    def _release(self, entry, broken=False):
+        with self.lock:
+            if not broken and not entry.expired and len(self.idle) < self.size:
+                self.idle.append(entry)
+                return
+        self._close(entry)
+
+    def _close(self, entry):
+        try:
+            entry.ydl.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled YoutubeDL ({self.name}): {e}")
+
+    @contextmanager
+    def checkout(self, outtmpl=None, fmt=None, progress_hook=None, postprocessor_hook=None):
+        """Borrow an instance, optionally overriding outtmpl, format and hooks."""
+        entry = self._acquire()
+        entry.uses += 1
+        ydl = entry.ydl
+        broken = False
+        try:
+            if outtmpl:
+                ydl.params['outtmpl']['default'] = outtmpl
+            if fmt:
+                ydl.params['format'] = fmt
+                ydl.format_selector = ydl.build_format_selector(fmt)
+            entry.progress_hook = progress_hook
+            entry.postprocessor_hook = postprocessor_hook
+            yield ydl
+        except BaseException as e:
+            # yt-dlp errors leave the instance usable; anything else may not
+            broken = not isinstance(e, (yt_dlp.utils.YoutubeDLError, DownloadJobError))
+            raise
+        finally:
+            entry.progress_hook = entry.postprocessor_hook = None
+            if outtmpl:
+                ydl.params['outtmpl']['default'] = self.opts['outtmpl']
+            if fmt:
+                ydl.params['format'] = self.opts['format']
+                ydl.format_selector = ydl.build_format_selector(self.opts['format'])
+            self._release(entry, broken)
+
+    def stats(self):
+        with self.lock:
+            return {'idle': len(self.idle), 'created': self.created, 'reused': self.reused}
+
+
+ydl_pools = {name: YoutubeDLPool(name, opts) for name, opts in YDL_PROFILES.items()}
+
+
+def warm_ydl_pools():
+    """Pre-create pooled YoutubeDL instances in the background."""
+    def warm_all():
+        for pool in ydl_pools.values():
+            pool.warm()
+    threading.Thread(target=warm_all, name='ydl-warmup', daemon=True).start()
+
+
+def _extract_info_with_ydl(profile, url, timeout=ANALYZE_TIMEOUT):
+    """Run yt_dlp.extract_info in a thread with a timeout to avoid hangs.
+
+    Returns the infodict on success or raises the underlying exception.
+    """
+    future = extract_executor.submit(_run_ydl_extract, profile, url)
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise TimeoutError(f"yt-dlp extract_info timed out after {timeout}s")
+
+
+def _run_ydl_extract(profile, url):
+    # Checked out inside the worker so a timed-out call keeps its instance
+    with pin_url_host(url), ydl_pools[profile].checkout() as ydl:
+        return ydl.extract_info(url, download=False)
+
+# ============================================================================
+# SEGMENTED RANGE DOWNLOADER
+# ============================================================================
+
+class SegmentedDownloadUnsupported(Exception):
+    """The resource can't be fetched in byte ranges (let yt-dlp handle it)."""
+
+
+class SegmentedDownloader:
+    """Fetch one HTTP resource as parallel byte ranges into ``dest``.
+
+    Data is written in place into ``dest + '.segmented'`` and every finished
+    range is recorded in the ``dest + '.segments.json'`` manifest, so after a
+    crash or restart only the ranges that were in flight are fetched again.
+    Segment size follows per-connection throughput (about
+    SEGMENT_TARGET_SECONDS per segment) and the number of connections is
+    hill-climbed against aggregate throughput every SEGMENT_ADAPT_INTERVAL.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, url, dest, headers=None, progress_hook=None, min_size=0):
+        self.url = url
+        self.dest = dest
+        self.part_path = dest + '.segmented'
+        self.manifest_path = dest + '.segments.json'
+        self.headers = dict(headers or {})
+        # Compressed bodies would break byte offsets
+        self.headers['Accept-Encoding'] = 'identity'
+        self.progress_hook = progress_hook
+        self.min_size = min_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SEGMENT_MAX_CONNECTIONS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.cond = threading.Condition()
+        self.total_size = None
+        self.done = []  # merged [start, end) ranges already on disk
+        self.pending = []  # [start, end) ranges not yet handed to a worker
+        self.completed_bytes = 0
+        self.inflight_bytes = 0
+        self.segment_size = SEGMENT_INITIAL_SIZE
+        self.connections = SEGMENT_INITIAL_CONNECTIONS
+        self.error = None
+        self._started = None
+        self._resumed_bytes = 0
+        self._last_report = 0.0
+        self._window_start = None
+        self._window_bytes = 0
+        self._last_rate = None
+
+    @classmethod
+    def discard(cls, dest):
+        """Remove leftover partial data and manifest for ``dest``."""
+        for path in (dest + '.segmented', dest + '.segments.json'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _probe(self):
+        """Confirm range support and return the total size in bytes."""
+        headers = {**self.headers, 'Range': 'bytes=0-0'}
+        with self.session.get(self.url, headers=headers, stream=True, timeout=(10, 30)) as resp:
+            content_range = resp.headers.get('Content-Range', '')
+            if resp.status_code != 206:
+                raise SegmentedDownloadUnsupported(f'HTTP {resp.status_code} for range probe')
+        m = re.match(r'bytes\s+\d+-\d+/(\d+)', content_range)
+        if not m:
+            raise SegmentedDownloadUnsupported('Unknown total size')
+        total = int(m.group(1))
+        if total < self.min_size:
+            raise SegmentedDownloadUnsupported(f'Too small for segmenting ({total} bytes)')
+        return total
+
+    def _load_manifest(self):
+        """Resume from a matching manifest, or preallocate a fresh part file."""
+        manifest = None
+        if os.path.exists(self.manifest_path) and os.path.exists(self.part_path):
+            try:
+                with open(self.manifest_path) as fh:
+                    manifest = json.load(fh)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable segment manifest {self.manifest_path}: {e}")
+
+        if manifest and manifest.get('total_size') == self.total_size:
+            self.done = [list(r) for r in manifest.get('done', [])]
+            self.completed_bytes = sum(end - start for start, end in self.done)
+            self._resumed_bytes = self.completed_bytes
+            logger.info(f"Resuming segmented download of {os.path.basename(self.dest)} "
+                        f"at {self.completed_bytes}/{self.total_size} bytes")
+        else:
+            with open(self.part_path, 'wb') as fh:
+                fh.truncate(self.total_size)
+            self.done = []
+            self._save_manifest()
+
+        # Everything not on disk yet is pending
+        offset = 0
+        for start, end in self.done:
+            if start > offset:
+                self.pending.append([offset, start])
+            offset = max(offset, end)
+        if offset < self.total_size:
+            self.pending.append([offset, self.total_size])
+
+    def _save_manifest(self):
+        """Atomically rewrite the manifest (caller holds cond or is single-threaded)."""
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump({'total_size': self.total_size, 'done': self.done, 'updated_at': time.time()}, fh)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _claim(self):
+        """Hand out the next range of ``segment_size`` bytes (caller holds cond)."""
+        start, end = self.pending[0]
+        seg_end = min(end, start + self.segment_size)
+        if seg_end == end:
+            self.pending.pop(0)
+        else:
+            self.pending[0][0] = seg_end
+        return start, seg_end
+
+    def _mark_done(self, start, end):
+        """Merge [start, end) into ``done`` (caller holds cond)."""
+        ranges = sorted(self.done + [[start, end]])
+        merged = [ranges[0]]
+        for s, e in ranges[1:]:
+            if s <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], e)
+            else:
+                merged.append([s, e])
+        self.done = merged
+
+    def _adapt(self, nbytes, elapsed):
+        """Retune segment size and parallelism after a segment (caller holds cond)."""
+        if elapsed > 0:
+            per_connection = nbytes / elapsed
+            self.segment_size = int(min(SEGMENT_MAX_SIZE, max(SEGMENT_MIN_SIZE,
+                                                              per_connection * SEGMENT_TARGET_SECONDS)))
+
+        now = time.time()
+        self._window_bytes += nbytes
+        window = now - self._window_start
+        if window < SEGMENT_ADAPT_INTERVAL:
+            return
+        rate = self._window_bytes / window
+        if self._last_rate is None or rate > self._last_rate * 1.1:
+            self.connections = min(SEGMENT_MAX_CONNECTIONS, self.connections + 1)
+        elif rate < self._last_rate * 0.9:
+            self.connections = max(SEGMENT_MIN_CONNECTIONS, self.connections - 1)
+        self._last_rate = rate
+        self._window_start = now
+        self._window_bytes = 0
+        self.cond.notify_all()
+
+    def _report(self, force=False):
+        if not self.progress_hook:
+            return
+        now = time.time()
+        with self.cond:
+            if not force and now - self._last_report < PROGRESS_MIN_INTERVAL:
+                return
+            self._last_report = now
+            downloaded = self.completed_bytes + self.inflight_bytes
+            contiguous = self.done[0][1] if self.done and self.done[0][0] == 0 else 0
+        elapsed = now - self._started
+        speed = (downloaded - self._resumed_bytes) / elapsed if elapsed > 0 else None
+        self.progress_hook({
+            'status': 'downloading',
+            'downloaded_bytes': downloaded,
+            'total_bytes': self.total_size,
+            'speed': speed,
+            'eta': int((self.total_size - downloaded) / speed) if speed else None,
+            'filename': self.dest,
+            'tmpfilename': self.part_path,
+            'contiguous_bytes': contiguous,
+        })
+
+    def _fetch(self, start, end):
+        """Download [start, end) into the part file, retrying transient errors."""
+        for attempt in range(SEGMENT_RETRIES):
+            written = 0
+            began = time.time()
+            try:
+                headers = {**self.headers, 'Range': f'bytes={start}-{end - 1}'}
+                with self.session.get(self.url, headers=headers, stream=True, timeout=(10, 60)) as resp:
+                    if resp.status_code == 200:
+                        raise SegmentedDownloadUnsupported('Server ignored the Range header')
+                    resp.raise_for_status()
+                    with open(self.part_path, 'r+b') as fh:
+                        fh.seek(start)
+                        for chunk in resp.iter_content(self.CHUNK_SIZE):
+                            chunk = chunk[:end - start - written]
+                            fh.write(chunk)
+                            written += len(chunk)
+                            with self.cond:
+                                self.inflight_bytes += len(chunk)
+                            self._report()
+                if written < end - start:
+                    raise IOError(f'Short read for bytes {start}-{end - 1}: {written} bytes')
+                with self.cond:
+                    self.inflight_bytes -= written
+                    self.completed_bytes += written
+                    self._mark_done(start, end)
+                    self._save_manifest()
+                    self._adapt(written, time.time() - began)
+                # The contiguous prefix may have grown; let tailing readers know
+                self._report(force=True)
+                return
+            except SegmentedDownloadUnsupported:
+                raise
+            except (requests.RequestException, OSError) as e:
+                with self.cond:
+                    self.inflight_bytes -= written
+                if attempt == SEGMENT_RETRIES - 1:
+                    raise
+                wait_time = 2 ** attempt
+                logger.warning(f"Segment {start}-{end - 1} failed on attempt {attempt + 1}, retrying in {wait_time}s: {e}")
+                time.sleep(wait_time)
+
+    def _worker(self, index):
+        while True:
+            with self.cond:
+                # Workers beyond the current connection limit stay parked
+                while index >= self.connections and self.pending and not self.error:
+                    self.cond.wait(0.5)
+                if self.error or not self.pending:
+                    return
+                start, end = self._claim()
+            try:
+                self._fetch(start, end)
+            except Exception as e:
+                with self.cond:
+                    self.error = self.error or e
+                    self.cond.notify_all()
+                return
+
+    def run(self):
+        """Download the whole resource to ``dest`` and return its path."""
+        self.total_size = self._probe()
+        self._load_manifest()
+        self._started = self._window_start = time.time()
+
+        workers = [threading.Thread(target=self._worker, args=(i,), daemon=True,
+                                    name=f'segment-{i}')
+                   for i in range(SEGMENT_MAX_CONNECTIONS)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        self.session.close()
+
+        if self.error:
+            raise self.error
+
+        os.replace(self.part_path, self.dest)
+        os.remove(self.manifest_path)
+        self._report(force=True)
+        logger.info(f"Segmented download finished: {os.path.basename(self.dest)} "
+                    f"({self.total_size} bytes, {self.connections} connections)")
+        return self.dest
+
+
+def _try_segmented_download(info, filename, progress_hook=None):
+    """Pre-fetch a progressive single-URL format with SegmentedDownloader.
+
+    Returns True if ``filename`` is complete on disk; yt-dlp then finds it
+    already downloaded and only runs its postprocessors. Returns False when
+    the format needs yt-dlp's own downloader (fragments, merges, cookies) or
+    the segmented attempt failed; partial data is kept for the next resume.
+    """
+    if not SEGMENTED_DOWNLOADS:
+        return False
+    if info.get('requested_formats') or info.get('fragments') or info.get('cookies'):
+        return False
+    if info.get('protocol') not in ('http', 'https') or not info.get('url'):
+        return False
+    size = info.get('filesize') or info.get('filesize_approx')
+    if size and size < SEGMENTED_MIN_FILESIZE:
+        return False
+    if os.path.exists(filename):
+        return True
+
+    try:
+        SegmentedDownloader(info['url'], filename, info.get('http_headers'),
+                            progress_hook, min_size=SEGMENTED_MIN_FILESIZE).run()
+        return True
+    except SegmentedDownloadUnsupported as e:
+        logger.info(f"Segmented download not possible, using yt-dlp: {e}")
+    except Exception as e:
+        logger.warning(f"Segmented download failed, falling back to yt-dlp: {e}")
+    return False
+
+# ============================================================================
+# DOWNLOAD JOBS & LIVE PROGRESS
+# ============================================================================
+
+class DownloadJobError(Exception):
+    """A download failure that maps to a specific HTTP status code."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+
+class DownloadJob:
+    """State of a single download, shared between the worker and listeners.
+
+    yt-dlp progress hooks fire many times per second; updates are folded into
+    one latest-state snapshot and only published (``seq`` bumped, listeners
+    woken) every PROGRESS_MIN_INTERVAL or on a phase change.
+
+    For progressive formats the hooks also track the file being written and
+    how many bytes of it are readable, waking file tailers on every advance.
+    """
+
+    TERMINAL = ('finished', 'error')
+
+    def __init__(self, url, quality, client_ip, audio_format='original', job_id=None):
+        # Tagged with the node in cluster mode; recovered jobs keep their ID
+        self.id = job_id or f"{cluster.tag}{uuid.uuid4().hex}"
+        self.recovered = False
+        self.url = url
+        self.quality = quality
+        self.audio_format = audio_format
+        self.client_ip = client_ip
+        self.created_at = time.time()
+        self.finished_at = None
+        self.status = 'queued'
+        self.progress = {}
+        self.queue = {}
+        self.result = None
+        self.error = None
+        self.http_status = None
+        self.seq = 0
+        self.cond = threading.Condition()
+        self._last_publish = 0.0
+        self.dedupe_key = None
+        self.progressive = None  # True/False once the format is known
+        self.download_name = None  # basename the download will be saved as
+        self.write_path = None  # file currently being written sequentially
+        self.write_offset = 0  # bytes of write_path that are on disk
+        self.final_size = None  # exact size once the server reports it
+
+    def _publish(self, force=False):
+        """Bump the event sequence and wake listeners (caller holds cond)."""
+        now = time.time()
+        if not force and now - self._last_publish < PROGRESS_MIN_INTERVAL:
+            return
+        self._last_publish = now
+        self.seq += 1
+        self.cond.notify_all()
+
+    def progress_hook(self, d):
+        """yt-dlp ``progress_hooks`` callback."""
+        with self.cond:
+            status = d.get('status')
+            if status == 'downloading':
+                total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                downloaded = d.get('downloaded_bytes') or 0
+                self.progress = {
+                    'downloaded_bytes': downloaded,
+                    'total_bytes': total,
+                    'percent': round(downloaded * 100.0 / total, 1) if total else None,
+                    'speed': d.get('speed'),
+                    'eta': d.get('eta'),
+                    'fragment_index': d.get('fragment_index'),
+                    'fragment_count': d.get('fragment_count'),
+                }
+                phase_changed = self.status != 'downloading'
+                self.status = 'downloading'
+                if self.progressive:
+                    # Segmented downloads only count their contiguous prefix
+                    self._advance_write(d.get('tmpfilename') or d.get('filename'),
+                                        d.get('contiguous_bytes', downloaded), d.get('total_bytes'))
+                self._publish(force=phase_changed)
+            elif status == 'finished':
+                self.progress.update({
+                    'downloaded_bytes': d.get('downloaded_bytes') or d.get('total_bytes'),
+                    'percent': 100.0,
+                    'speed': None,
+                    'eta': 0,
+                })
+                if self.progressive:
+                    size = d.get('total_bytes') or d.get('downloaded_bytes')
+                    self._advance_write(d.get('filename'), size, size)
+                self._publish(force=True)
+
+    def _advance_write(self, path, offset, total):
+        """Record the readable prefix of the file being written (caller holds cond)."""
+        if path:
+            self.write_path = path
+        self.write_offset = offset or 0
+        if total:
+            self.final_size = total
+        self.cond.notify_all()
+
+    def set_progressive(self, progressive, download_name, size=None):
+        """Record whether readers may tail the file while it downloads."""
+        with self.cond:
+            self.progressive = progressive
+            self.download_name = download_name
+            self.final_size = size
+            self.cond.notify_all()
+
+    def postprocessor_hook(self, d):
+        """yt-dlp ``postprocessor_hooks`` callback."""
+        if d.get('status') == 'started':
+            self.start_postprocessing(d.get('postprocessor'))
+
+    def start_postprocessing(self, name):
+        with self.cond:
+            self.status = 'postprocessing'
+            self.progress['postprocessor'] = name
+            self._publish(force=True)
+
+    def set_queue_info(self, position, estimated_wait):
+        """Record the job's place in the scheduler queue."""
+        with self.cond:
+            changed = self.queue.get('position') != position
+            self.queue = {
+                'position': position,
+                'estimated_wait': round(estimated_wait),
+                'estimated_start': round(time.time() + estimated_wait),
+            }
+            if changed:
+                self._publish(force=True)
+
+    def set_status(self, status):
+        with self.cond:
+            self.status = status
+            self._publish(force=True)
+
+    def finish(self, result):
+        with self.cond:
+            self.status = 'finished'
+            self.result = result
+            self.finished_at = time.time()
+            self._publish(force=True)
+
+    def fail(self, message, http_status=500):
+        with self.cond:
+            self.status = 'error'
+            self.error = message
+            self.http_status = http_status
+            self.finished_at = time.time()
+            self._publish(force=True)
+
+    @property
+    def is_terminal(self):
+        return self.status in self.TERMINAL
+
+    def snapshot(self):
+        """JSON-serialisable view of the job (caller may or may not hold cond)."""
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'quality': self.quality,
+            'progress': dict(self.progress),
+            'created_at': self.created_at,
+        }
+        if self.status == 'queued' and self.queue:
+            data['queue'] = dict(self.queue)
+        if self.progressive is not None:
+            data['progressive'] = self.progressive
+        if self.recovered:
+            data['recovered'] = True
+        if self.result is not None:
+            data['result'] = self.result
+        if self.error is not None:
+            data['error'] = self.error
+        return data
+
+    def wait(self, timeout=None):
+        """Block until the job finishes (or ``timeout`` elapses)."""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.is_terminal, timeout)
+
+    def wait_for_update(self, last_seq, timeout):
+        """Block until ``seq`` moves past ``last_seq`` or ``timeout`` elapses.
+
+        Returns ``(seq, snapshot)``.
+        """
+        with self.cond:
+            # Predicate wait: file tailers are woken far more often than seq moves
+            self.cond.wait_for(lambda: self.seq > last_seq or self.is_terminal, timeout)
+            return self.seq, self.snapshot()
+
+
+def _prune_jobs():
+    """Drop finished jobs older than JOB_RETENTION."""
+    cutoff = time.time() - JOB_RETENTION
+    with download_jobs_lock:
+        for job_id in [j.id for j in download_jobs.values()
+                       if j.finished_at and j.finished_at < cutoff]:
+            del download_jobs[job_id]
+        for key in [k for k, j in active_downloads.items() if j.is_terminal]:
+            del active_downloads[key]
+
+
+def _attach_or_create_job(url, quality, client_ip, audio_format):
+    """Return ``(job, created)``, sharing a running job for identical requests.
+
+    A new job is registered before it is published for sharing, so every
+    job ID handed out is queryable (even if submission then fails).
+    """
+    key = (canonical_video_key(url), quality, audio_format)
+    _prune_jobs()
+    with download_jobs_lock:
+        job = active_downloads.get(key)
+        if job is not None and not job.is_terminal:
+            return job, False
+        job = DownloadJob(url, quality, client_ip, audio_format)
+        job.dedupe_key = key
+        download_jobs[job.id] = job
+        active_downloads[key] = job
+        return job, True
+
+
+def _release_job_key(job):
+    """Stop sharing ``job`` with new identical requests."""
+    with download_jobs_lock:
+        if active_downloads.get(job.dedupe_key) is job:
+            del active_downloads[job.dedupe_key]
+
+
+def _register_job(job):
+    _prune_jobs()
+    with download_jobs_lock:
+        download_jobs[job.id] = job
+    return job
+
+
+def _get_job(job_id):
+    with download_jobs_lock:
+        return download_jobs.get(job_id)
+
+
+def _format_sse(event, data, event_id=None):
+    """Encode one Server-Sent Events message."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def _sse_event_name(snapshot):
+    status = snapshot['status']
+    if status == 'finished':
+        return 'done'
+    if status == 'error':
+        return 'error'
+    if status == 'postprocessing':
+        return 'postprocess'
+    return 'progress'
+
+
+def _job_event_stream(job, last_seq):
+    """Yield SSE messages for ``job`` for at most SSE_STREAM_WINDOW seconds.
+
+    Each open stream holds a Waitress worker thread, and EventSource
+    reconnects SSE_RETRY_MS after a window ends (with ``Last-Event-ID``, so
+    the latest state is replayed), so a listener owns a thread for most of
+    the download. The window only bounds a single response; the thread cost
+    is capped by SSE_MAX_STREAMS, beyond which clients poll snapshots.
+    """
+    deadline = time.time() + SSE_STREAM_WINDOW
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        seq, snapshot = job.wait_for_update(last_seq, min(SSE_HEARTBEAT_INTERVAL, remaining))
+        if seq <= last_seq and not job.is_terminal:
+            yield ": heartbeat\n\n"
+            continue
+        last_seq = max(seq, last_seq)
+        yield _format_sse(_sse_event_name(snapshot), snapshot, seq)
+        if job.is_terminal:
+            return
+
+
+def _tail_job_file(job):
+    """Yield a download's bytes as they reach disk, until the job finishes.
+
+    Readers block on ``job.cond``, which the progress hooks notify whenever
+    the readable prefix grows, and only read up to ``write_offset``. The open
+    handle survives the .part -> final rename; if yt-dlp restarts the file
+    (e.g. after a failed segmented attempt) we reopen it and wait for the new
+    writer to pass our position, since the bytes are the same.
+    """
+    pos = 0
+    seen = -1  # write_offset at our last read
+    fh = opened = None
+    try:
+        while True:
+            with job.cond:
+                progressed = job.cond.wait_for(
+                    lambda: job.is_terminal or job.write_offset != seen or job.write_path != opened,
+                    PROGRESSIVE_STALL_TIMEOUT)
+                status, path, offset = job.status, job.write_path, job.write_offset
+                result = job.result
+            if not progressed:
+                logger.warning(f"Progressive read of job {job.id} stalled at {pos} bytes")
+                return
+            if status == 'error':
+                return  # the short body tells the client the transfer failed
+            if status == 'finished':
+                path, offset = os.path.join(DOWNLOAD_DIR, result['filename']), None
+            if path != opened:
+                opened = path
+                try:
+                    new_fh = open(path, 'rb')
+                except OSError:
+                    new_fh = None  # renamed under us; keep reading the old handle
+                if new_fh:
+                    if fh:
+                        fh.close()
+                    fh = new_fh
+            seen = offset
+            if fh is None:
+                if status == 'finished':
+                    return
+                continue
+            fh.seek(pos)
+            while offset is None or pos < offset:
+                want = PROGRESSIVE_CHUNK_SIZE if offset is None else min(PROGRESSIVE_CHUNK_SIZE, offset - pos)
+                chunk = fh.read(want)
+                if not chunk:
+                    break  # still in the writer's buffer; wait for the next advance
+                pos += len(chunk)
+                yield chunk
+            if status == 'finished':
+                return
+    finally:
+        if fh:
+            fh.close()
+
+
+def _describe_download_error(error_msg):
+    """Turn a yt-dlp DownloadError message into a user-facing one."""
+    if '403' in error_msg or 'Forbidden' in error_msg:
+        return "Access denied. This video may be restricted, age-restricted, or require sign-in. Try a different video or quality."
+    elif 'Private video' in error_msg:
+        return "This is a private video and cannot be downloaded."
+    elif 'Video unavailable' in error_msg:
+        return "Video is unavailable or has been removed."
+    elif 'sign in' in error_msg.lower():
+        return "This video requires authentication. Try a public video instead."
+    return error_msg
+
+
+def _download_format(quality, audio_format):
+    """Return the yt-dlp option profile and format selector for a download."""
+    if quality == 'audio':
+        # Fetch the source audio as-is; any conversion happens afterwards
+        return 'download-audio', AUDIO_FORMATS[audio_format][0]
+    # Extract resolution number (e.g., '1080p' -> '1080')
+    resolution = quality.replace('p', '') if quality else '720'
+    return 'download-video', f'best[height<={resolution}]'  # Simpler format selection
+
+
+def _is_progressive(info, job):
+    """Whether the downloaded file is final, byte for byte, as it is written."""
+    if info.get('requested_formats') or info.get('fragments'):
+        return False
+    if info.get('protocol') not in ('http', 'https'):
+        return False
+    if (info.get('container') or '').endswith('_dash'):
+        return False  # rewritten by a fixup postprocessor
+    return job.quality != 'audio' or AUDIO_FORMATS[job.audio_format][2] is None
+
+
+def _run_download(job):
+    """Download ``job.url`` with yt-dlp and return the success payload."""
+    url, quality = job.url, job.quality
+
+    # Generate safe filename base
+    safe_filename = f"download_{cluster.tag}{hashlib.md5(url.encode()).hexdigest()[:8]}"
+
+    outtmpl = os.path.join(DOWNLOAD_DIR, f'{safe_filename}_%(title).100s.%(ext)s')
+
+    # Pick the option profile and format selector based on quality
+    profile, fmt = _download_format(quality, job.audio_format)
+
+    # Download the video
+    with pin_url_host(url), ydl_pools[profile].checkout(outtmpl=outtmpl, fmt=fmt,
+                                     progress_hook=job.progress_hook,
+                                     postprocessor_hook=job.postprocessor_hook) as ydl:
+        info = ydl.extract_info(url, download=False)
+
+        # Refuse before fetching anything if the file can't fit on disk
+        formats = info.get('requested_formats') or [info]
+        size = sum((f.get('filesize') or f.get('filesize_approx') or 0) for f in formats)
+        download_scheduler.reserve(job, size)
+
+        # Single-file formats written front to back can be tailed by readers
+        # while they download; merges, fragments and conversions cannot.
+        job.set_progressive(_is_progressive(info, job),
+                            os.path.basename(ydl.prepare_filename(info)),
+                            info.get('filesize'))
+
+        # Progressive single-URL formats are fetched as parallel byte ranges
+        # first; yt-dlp then finds the file in place and only postprocesses.
+        _try_segmented_download(info, ydl.prepare_filename(info), job.progress_hook)
+
+        info = ydl.process_ie_result(info, download=True)
+        filename = ydl.prepare_filename(info)
+        # yt-dlp may have finished a download the segmented path gave up on
+        SegmentedDownloader.discard(filename)
+
+        # Remux or transcode audio into the requested format
+        if quality == 'audio':
+            filename = _finalize_audio(filename, info, job)
+
+        # Check file exists and size
+        if os.path.exists(filename):
+            filesize = os.path.getsize(filename)
+            if filesize > MAX_FILESIZE:
+                os.remove(filename)
+                logger.warning(f"File exceeds max size: {filesize} bytes")
+                raise DownloadJobError('File size exceeds maximum limit (500MB)', 413)
+        else:
+            raise DownloadJobError('Download completed but file not found', 500)
+
+        logger.info(f"Download completed: {os.path.basename(filename)} ({filesize} bytes)")
+
+        return {
+            'success': True,
+            'message': 'Video downloaded successfully',
+            'filename': os.path.basename(filename),
+            'title': sanitize_text(info.get('title', 'Unknown')),
+            'filesize': filesize
+        }
+
+
+def _run_ffmpeg(source, target, codec_args):
+    """Convert ``source`` into ``target``, replacing it atomically on success."""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        raise DownloadJobError('Audio conversion is not available on this server', 500)
+
+    stem, ext = os.path.splitext(target)
+    # Unique per run so concurrent conversions of one target never share a
+    # temp file; keep the extension so ffmpeg picks the muxer
+    tmp_path = f"{stem}.tmp-{uuid.uuid4().hex[:8]}{ext}"
+    cmd = [ffmpeg, '-y', '-nostdin', '-loglevel', 'error', '-i', source,
+           '-vn', '-map_metadata', '0', *codec_args, tmp_path]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True, timeout=AUDIO_TRANSCODE_TIMEOUT)
+        os.replace(tmp_path, target)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"ffmpeg failed for {os.path.basename(source)}: {e.stderr.decode(errors='replace')[:500]}")
+        raise DownloadJobError('Audio conversion failed', 500)
+    except subprocess.TimeoutExpired:
+        logger.error(f"ffmpeg timed out after {AUDIO_TRANSCODE_TIMEOUT}s for {os.path.basename(source)}")
+        raise DownloadJobError('Audio conversion timed out', 504)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return target
+
+
+def _submit_transcode(source, target, encoder):
+    """Queue a transcode on the bounded pool, sharing it with concurrent requests."""
+    with transcode_lock:
+        future = transcode_jobs.get(target)
+        # Finished files are found on disk by the caller; only in-flight work is shared
+        if future is None or future.done():
+            codec_args = ['-c:a', encoder, '-b:a', AUDIO_TRANSCODE_BITRATE, '-threads', '1']
+            future = transcode_executor.submit(_run_ffmpeg, source, target, codec_args)
+            transcode_jobs[target] = future
+        return future
+
+
+def _finalize_audio(source, info, job):
+    """Deliver downloaded audio in ``job.audio_format``.
+
+    The source codec is stream-copied whenever it already matches (a cheap
+    remux at most); only a codec change is transcoded, on the transcode pool.
+    Converted files stay in DOWNLOAD_DIR and are reused by later requests.
+    """
+    _, codec_prefix, ext, encoder = AUDIO_FORMATS[job.audio_format]
+    if ext is None:
+        return source
+
+    target = os.path.splitext(source)[0] + '.' + ext
+    if target == source or os.path.exists(target):
+        return target
+
+    source_codec = (info.get('acodec') or '').lower()
+    if source_codec.startswith(codec_prefix):
+        job.start_postprocessing('Remux')
+        return _run_ffmpeg(source, target, ['-c:a', 'copy'])
+
+    job.start_postprocessing('Transcode')
+    return _submit_transcode(source, target, encoder).result()
+
+
+def _execute_download_job(job):
+    """Run ``job`` to completion, recording the result or error on it."""
+    job.set_status('starting')
+    job_journal.record('started', job, status='starting')
+    try:
+        job.finish(_run_download(job))
+    except DownloadJobError as e:
+        job.fail(str(e), e.status)
+    except yt_dlp.utils.DownloadError as e:
+        error_msg = str(e)
+        logger.exception(f"Download error: {error_msg}")
+        job.fail(f'Download failed: {_describe_download_error(error_msg)}', 400)
+    except Exception as e:
+        logger.exception(f"Unexpected error in download job {job.id}: {e}")
+        job.fail('Download failed. Please try again or use a different video.', 500)
+    job_journal.record_outcome(job)
+
+
+class DownloadScheduler:
+    """Admission control and fair scheduling for download jobs.
+
+    Jobs wait in one FIFO per client IP and free slots are handed out
+    round-robin across clients, so a client with twenty queued downloads
+    gets one turn per round like everyone else. Running downloads are
+    capped globally and per client, and jobs whose estimated size would not
+    fit in DOWNLOAD_DIR are refused before any bytes are fetched.
+    """
+
+    def __init__(self, executor, max_running, max_per_client, max_queued_per_client):
+        self.executor = executor
+        self.max_running = max_running
+        self.max_per_client = max_per_client
+        self.max_queued_per_client = max_queued_per_client
+        self.lock = threading.Lock()
+        self.queues = {}  # ip -> deque[DownloadJob]
+        self.rotation = deque()  # IPs with queued jobs, in service order
+        self.running = {}  # job_id -> DownloadJob
+        self.running_per_client = {}  # ip -> count
+        self.started_at = {}  # job_id -> start timestamp
+        self.reserved = {}  # job_id -> estimated bytes
+        self.avg_duration = DOWNLOAD_DURATION_ESTIMATE
+        self.paused = False  # set while draining: queued jobs stay queued
+        self.idle = threading.Condition(self.lock)
+
+    def submit(self, job, estimated_size=None):
+        """Queue ``job`` or raise DownloadJobError if it can't be admitted."""
+        with self.lock:
+            queue = self.queues.get(job.client_ip)
+            if queue and len(queue) >= self.max_queued_per_client:
+                raise DownloadJobError('Too many queued downloads. Please wait for your current downloads to finish.', 429)
+            if estimated_size:
+                self._check_space(estimated_size)
+            if queue is None:
+                queue = self.queues[job.client_ip] = deque()
+                self.rotation.append(job.client_ip)
+            queue.append(job)
+            self._dispatch()
+            self._publish_positions()
+
+    def reserve(self, job, size):
+        """Claim disk space for a running job once its real size is known."""
+        if not size:
+            return
+        with self.lock:
+            self.reserved.pop(job.id, None)
+            self._check_space(size)
+            self.reserved[job.id] = size
+
+    def _check_space(self, size):
+        """Raise if ``size`` bytes would not fit (caller holds lock)."""
+        if size > MAX_FILESIZE:
+            raise DownloadJobError('File size exceeds maximum limit', 413)
+        outstanding = sum(max(0, reserved - (self.running[job_id].progress.get('downloaded_bytes') or 0))
+                          for job_id, reserved in self.reserved.items() if job_id in self.running)
+        free = shutil.disk_usage(DOWNLOAD_DIR).free - outstanding - DISK_SPACE_MARGIN
+        if size > free:
+            logger.warning(f"Refusing download of {size} bytes, only {free} bytes available")
+            raise DownloadJobError('Not enough storage space on the server for this download. Try a lower quality.', 507)
+
+    def _dispatch(self):
+        """Start queued jobs round-robin while slots are free (caller holds lock)."""
+        skipped = 0
+        while not self.paused and len(self.running) < self.max_running and skipped < len(self.rotation):
+            ip = self.rotation[0]
+            self.rotation.rotate(-1)
+            if self.running_per_client.get(ip, 0) >= self.max_per_client:
+                skipped += 1
+                continue
+            skipped = 0
+            job = self.queues[ip].popleft()
+            if not self.queues[ip]:
+                del self.queues[ip]
+                self.rotation.remove(ip)
+            self.running[job.id] = job
+            self.running_per_client[ip] = self.running_per_client.get(ip, 0) + 1
+            self.started_at[job.id] = time.time()
+            self.executor.submit(self._run, job)
+
+    def _run(self, job):
+        try:
+            _execute_download_job(job)
+        finally:
+            with self.lock:
+                self.running.pop(job.id, None)
+                self.reserved.pop(job.id, None)
+                remaining = self.running_per_client.get(job.client_ip, 1) - 1
+                if remaining:
+                    self.running_per_client[job.client_ip] = remaining
+                else:
+                    self.running_per_client.pop(job.client_ip, None)
+                duration = time.time() - self.started_at.pop(job.id, time.time())
+                self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+                self._dispatch()
+                self._publish_positions()
+                self.idle.notify_all()
+
+    def drain(self, timeout):
+        """Stop starting queued jobs and wait for running ones; True if none remain."""
+        with self.lock:
+            self.paused = True
+            return self.idle.wait_for(lambda: not self.running, timeout)
+
+    def _queue_positions(self):
+        """Return queued jobs in the order round-robin service will start them."""
+        queues = [list(self.queues[ip]) for ip in self.rotation]
+        order = []
+        depth = 0
+        while any(depth < len(q) for q in queues):
+            order.extend(q[depth] for q in queues if depth < len(q))
+            depth += 1
+        return order
+
+    def _publish_positions(self):
+        """Push queue position and estimated start to every queued job (caller holds lock)."""
+        now = time.time()
+        # Soonest a running download is expected to free its slot
+        next_free = min((max(0.0, self.avg_duration - (now - started))
+                         for started in self.started_at.values()), default=0.0)
+        for position, job in enumerate(self._queue_positions()):
+            waves = position // self.max_running
+            job.set_queue_info(position + 1, next_free + waves * self.avg_duration)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'running': len(self.running),
+                'queued': sum(len(q) for q in self.queues.values()),
+                'clients_waiting': len(self.queues),
+                'avg_duration': round(self.avg_duration, 1),
+                'draining': self.paused,
+            }
+
+
+download_scheduler = DownloadScheduler(download_executor, MAX_CONCURRENT_DOWNLOADS,
+                                       MAX_DOWNLOADS_PER_CLIENT, MAX_QUEUED_PER_CLIENT)
+
+
+def _estimate_download_size(url, quality):
+    """Best-effort size estimate from a cached analysis of ``url``."""
+    cached = analyze_cache.get(url)
+    if not cached or quality == 'audio':
+        return None
+    try:
+        limit = int(quality.rstrip('p'))
+    except ValueError:
+        return None
+    candidates = [f for f in cached[1].get('formats', []) if f.get('height') and f['height'] <= limit]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda f: f['height']).get('filesize')
+
+# ============================================================================
+# JOB JOURNAL, GRACEFUL SHUTDOWN & RECOVERY
+# ============================================================================
+
+class JobJournal:
+    """Append-only JSONL log of download job lifecycles in DOWNLOAD_DIR.
+
+    Each line is one event (created, started, finished, failed, interrupted)
+    carrying the job's new ``status``; replaying the file gives every job's
+    latest state. A torn last line from a crash is skipped. Startup rewrites
+    the file as one snapshot line per job still worth keeping.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self._fh = None
+        self.records = 0
+
+    def _current_path(self):
+        return os.path.join(DOWNLOAD_DIR, JOB_JOURNAL_PATH)
+
+    def _open(self):
+        """Open (or reopen, if DOWNLOAD_DIR moved) the journal (caller holds lock)."""
+        path = self._current_path()
+        if self._fh is None or self.path != path:
+            if self._fh:
+                self._fh.close()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._fh = open(path, 'a', encoding='utf-8')
+            self.path = path
+        return self._fh
+
+    def record(self, event, job, **fields):
+        line = json.dumps({'event': event, 'job_id': job.id, 'ts': time.time(), **fields})
+        with self.lock:
+            try:
+                fh = self._open()
+                fh.write(line + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+                self.records += 1
+            except OSError as e:
+                logger.error(f"Job journal write failed: {e}")
+
+    def replay(self):
+        """Latest state per job ID, in creation order."""
+        states = OrderedDict()
+        try:
+            with open(self._current_path(), encoding='utf-8') as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    state = states.setdefault(entry['job_id'], {})
+                    state.update({k: v for k, v in entry.items() if k != 'event'})
+        except FileNotFoundError:
+            pass
+        return states
+
+    def compact(self, states):
+        """Atomically replace the journal with one snapshot line per state."""
+        with self.lock:
+            if self._fh:
+                self._fh.close()
+                self._fh = None
+            path = self._current_path()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w', encoding='utf-8') as fh:
+                for state in states:
+                    fh.write(json.dumps({'event': 'snapshot', **state}) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(path + '.tmp', path)
+
+    def record_created(self, job):
+        """Journal a new job; must precede submission so it is the job's first line."""
+        self.record('created', job, status='queued', url=job.url, quality=job.quality,
+                    audio_format=job.audio_format, client_ip=job.client_ip,
+                    created_at=job.created_at)
+
+    def record_outcome(self, job):
+        if job.status == 'finished':
+            self.record('finished', job, status='finished', result=job.result)
+        else:
+            self.record('failed', job, status='error', error=job.error, http_status=job.http_status)
+
+    def stats(self):
+        with self.lock:
+            return {'path': self._current_path(), 'records': self.records}
+
+
+job_journal = JobJournal()
+
+PARTIAL_SUFFIXES = ('.part', '.ytdl', '.segmented', '.segments.json', '.segments.json.tmp')
+
+def _discard_partials(url):
+    """Delete unfinished download files left behind for ``url``."""
+    prefix = f"download_{cluster.tag}{hashlib.md5(url.encode()).hexdigest()[:8]}_"
+    for name in os.listdir(DOWNLOAD_DIR):
+        if name.startswith(prefix) and (name.endswith(PARTIAL_SUFFIXES) or '.part-Frag' in name):
+            try:
+                os.remove(os.path.join(DOWNLOAD_DIR, name))
+            except OSError as e:
+                logger.warning(f"Could not remove partial file {name}: {e}")
+
+
+def recover_jobs():
+    """Rebuild jobs from the journal after a restart.
+
+    Finished and failed jobs within JOB_RETENTION stay queryable under their
+    IDs. Unfinished ones are queued again (yt-dlp and the segmented
+    downloader resume from their partial files); those older than
+    JOB_RETENTION are failed and their partial files removed.
+    Returns ``{'restored': n, 'resumed': n, 'abandoned': n}``.
+    """
+    now = time.time()
+    cutoff = now - JOB_RETENTION
+    kept, resume, abandon = [], [], []
+    for job_id, state in job_journal.replay().items():
+        if 'url' not in state:
+            continue
+        status = state.get('status')
+        if status in DownloadJob.TERMINAL:
+            if state.get('ts', 0) >= cutoff:
+                kept.append(state)
+        elif state.get('created_at', 0) >= cutoff:
+            resume.append(state)
+        else:
+            abandon.append(state)
+
+    resumed_urls = {state['url'] for state in resume}
+    for state in abandon:
+        if state['url'] not in resumed_urls:
+            _discard_partials(state['url'])
+        state.update(status='error', error='Download was interrupted by a server restart. Please try again.',
+                     http_status=503, ts=now)
+        kept.append(state)
+    job_journal.compact(kept + resume)
+
+    def rebuild(state):
+        job = DownloadJob(state['url'], state['quality'], state.get('client_ip', 'unknown'),
+                          state.get('audio_format', 'original'), job_id=state['job_id'])
+        job.created_at = state.get('created_at', job.created_at)
+        job.recovered = True
+        return job
+
+    for state in kept:
+        job = rebuild(state)
+        if state['status'] == 'finished':
+            job.finish(state.get('result'))
+        else:
+            job.fail(state.get('error') or 'Download failed.', state.get('http_status') or 500)
+        job.finished_at = state['ts']
+        _register_job(job)
+
+    for state in resume:
+        job = rebuild(state)
+        job.dedupe_key = (canonical_video_key(job.url), job.quality, job.audio_format)
+        with download_jobs_lock:
+            active_downloads.setdefault(job.dedupe_key, job)
+        _register_job(job)
+        try:
+            download_scheduler.submit(job)
+        except DownloadJobError as e:
+            job.fail(str(e), e.status)
+            job_journal.record_outcome(job)
+        logger.info(f"Resumed download job {job.id} after restart")
+
+    summary = {'restored': len(kept) - len(abandon), 'resumed': len(resume), 'abandoned': len(abandon)}
+    if resume or abandon:
+        logger.info(f"Recovered jobs from journal: {summary}")
+    return summary
+
+
+def drain_and_checkpoint(timeout=SHUTDOWN_DRAIN_TIMEOUT):
+    """Stop taking new work, let running downloads finish until ``timeout``,
+    then journal every unfinished job so the next start resumes it.
+
+    Returns the number of jobs left unfinished.
+    """
+    shutdown_event.set()
+    drained = download_scheduler.drain(timeout)
+    with download_jobs_lock:
+        unfinished = [job for job in download_jobs.values() if not job.is_terminal]
+    for job in unfinished:
+        job_journal.record('interrupted', job, status='interrupted', was=job.status)
+    logger.info(f"Shutdown drain {'completed' if drained else 'timed out'}; "
+                f"{len(unfinished)} unfinished job(s) checkpointed")
+    return len(unfinished)
+
+# ============================================================================
+# DIRECT-URL DELIVERY
+# ============================================================================
+
+def direct_url_expiry(media_url):
+    """Expiry (epoch seconds) from a signed URL's ``expire`` parameter, or None."""
+    try:
+        return int(dict(parse_qsl(urlparse(media_url).query))['expire'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _direct_delivery_blocker(info, ydl, audio_format):
+    """Why the selected format can't be fetched by the browser, or None."""
+    if info.get('requested_formats'):
+        return 'separate video and audio streams must be merged'
+    if info.get('protocol') not in ('http', 'https') or not info.get('url'):
+        return f"protocol {info.get('protocol')} needs the server-side downloader"
+    if info.get('cookies'):
+        return 'the media URL requires cookies'
+    if audio_format != 'original':
+        return 'audio must be remuxed or transcoded'
+    # Headers we send anyway are fine; anything the extractor added is required
+    defaults = ydl.params.get('http_headers', {})
+    extra = sorted(k for k, v in (info.get('http_headers') or {}).items() if defaults.get(k) != v)
+    if extra:
+        return f"the media URL requires headers: {', '.join(extra)}"
+    return None
+
+
+def _probe_direct_url(url, quality, audio_format, client_ip):
+    """Extract the selected format; returns (resolution, cacheable)."""
+    profile, fmt = _download_format(quality, audio_format)
+    with pin_url_host(url), ydl_pools[profile].checkout(fmt=fmt) as ydl:
+        info = ydl.extract_info(url, download=False)
+        blocker = _direct_delivery_blocker(info, ydl, audio_format)
+    if blocker:
+        return {'fallback': blocker}, True
+    # Signed URLs locked to our address are useless to other clients, and
+    # one locked to this client must not be cached and handed to others
+    bound_ip = dict(parse_qsl(urlparse(info['url']).query)).get('ip')
+    if bound_ip and bound_ip != client_ip:
+        return {'fallback': 'the media URL is bound to the server address'}, False
+    expires_at = direct_url_expiry(info['url'])
+    title = sanitize_text(info.get('title', 'video'))
+    ext = info.get('ext') or 'mp4'
+    return {
+        'direct_url': info['url'],
+        'expires_at': expires_at,
+        'title': title,
+        'ext': ext,
+        'filesize': info.get('filesize') or info.get('filesize_approx'),
+        'suggested_filename': sanitize_filename(f"{title}.{ext}"),
+    }, not bound_ip
+
+
+def resolve_direct_delivery(url, quality, audio_format, client_ip):
+    """Resolve the direct media URL for a download, honoring its expiry.
+
+    Returns a dict with ``direct_url`` and ``expires_at``, or with
+    ``fallback`` (the reason) when the file has to be proxied.
+    """
+    key = (canonical_video_key(url), quality, audio_format)
+    now = time.time()
+    cached = direct_url_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    future = extract_executor.submit(_probe_direct_url, url, quality, audio_format, client_ip)
+    try:
+        resolution, cacheable = future.result(timeout=ANALYZE_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise TimeoutError(f"yt-dlp extract_info timed out after {ANALYZE_TIMEOUT}s")
+
+    expires_at = resolution.get('expires_at')
+    if expires_at is None:
+        valid_until = now + DIRECT_URL_DEFAULT_TTL
+    else:
+        valid_until = expires_at - DIRECT_URL_EXPIRY_MARGIN
+        if valid_until <= now:
+            return {'fallback': 'the media URL expires too soon'}
+    if cacheable:
+        direct_url_cache[key] = (valid_until, resolution)
+    return resolution
+
+
+def direct_delivery_response(resolution, delivery):
+    """302 to the media URL, or describe it as JSON, with its expiry."""
+    expires_at = resolution['expires_at']
+    max_age = max(0, int(expires_at - time.time() - DIRECT_URL_EXPIRY_MARGIN)) if expires_at else DIRECT_URL_DEFAULT_TTL
+    if delivery == 'redirect':
+        response = redirect(resolution['direct_url'], code=302)
+    else:
+        response = jsonify({
+            'success': True,
+            'delivery': 'direct',
+            **resolution,
+            'expires_in': int(expires_at - time.time()) if expires_at else None,
+        })
+    # Neither we nor the browser may reuse the URL past its expiry
+    response.headers['Cache-Control'] = f'private, max-age={max_age}'
+    if expires_at:
+        response.headers['X-Direct-URL-Expires'] = str(expires_at)
+    return response
+
+# ============================================================================
+# EGRESS SHAPING
+# ============================================================================
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at ``rate`` tokens per second.
+
+    ``consume`` lets the balance go negative and sleeps off the debt, so
+    concurrent callers are served in arrival order and large requests are
+    never starved. A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount):
+        """Take ``amount`` tokens, blocking until they are available."""
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def try_consume(self, amount=1):
+        """Take ``amount`` tokens if available right now; never blocks."""
+        if not self.rate:
+            return True
+        with self.lock:
+            self._refill()
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+
+class ThroughputMeter:
+    """Total bytes plus a rate over the last THROUGHPUT_WINDOW seconds."""
+
+    def __init__(self):
+        self.total = 0
+        self.samples = deque()  # (monotonic time, bytes)
+        self.lock = threading.Lock()
+
+    def record(self, nbytes):
+        now = time.monotonic()
+        with self.lock:
+            self.total += nbytes
+            self.samples.append((now, nbytes))
+            self._evict(now)
+
+    def _evict(self, now):
+        while self.samples and now - self.samples[0][0] > THROUGHPUT_WINDOW:
+            self.samples.popleft()
+
+    @property
+    def idle(self):
+        with self.lock:
+            self._evict(time.monotonic())
+            return not self.samples
+
+    def stats(self):
+        with self.lock:
+            self._evict(time.monotonic())
+            window_bytes = sum(n for _, n in self.samples)
+            return {'bytes': self.total, 'rate': round(window_bytes / THROUGHPUT_WINDOW)}
+
+
+class EgressShaper:
+    """Throttle served files with global and per-client token buckets.
+
+    Traffic is split into lanes. ``interactive`` (API JSON, frontend assets,
+    small files) bypasses the buckets entirely; ``bulk`` file transfers draw
+    from their client's bucket and the shared global bucket, so a few fast
+    clients can't use up the instance's egress and slow everything else.
+    """
+
+    LANES = ('interactive', 'bulk')
+
+    def __init__(self, global_rate, client_rate, burst_seconds):
+        self.client_rate = client_rate
+        self.burst_seconds = burst_seconds
+        self.global_bucket = TokenBucket(global_rate, global_rate * burst_seconds)
+        self.client_buckets = {}  # ip -> TokenBucket
+        self.lane_meters = {lane: ThroughputMeter() for lane in self.LANES}
+        self.client_meters = {}  # ip -> ThroughputMeter
+        self.active_streams = {lane: 0 for lane in self.LANES}
+        self.lock = threading.Lock()
+
+    def lane_for(self, size):
+        return 'interactive' if size is not None and size < EGRESS_BYPASS_SIZE else 'bulk'
+
+    def _client(self, ip):
+        with self.lock:
+            bucket = self.client_buckets.get(ip)
+            if bucket is None:
+                self._prune()
+                bucket = self.client_buckets[ip] = TokenBucket(
+                    self.client_rate, self.client_rate * self.burst_seconds)
+                self.client_meters[ip] = ThroughputMeter()
+            return bucket, self.client_meters[ip]
+
+    def _prune(self):
+        """Forget idle clients (caller holds lock)."""
+        for ip in [ip for ip, meter in self.client_meters.items() if meter.idle]:
+            self.client_meters.pop(ip, None)
+            self.client_buckets.pop(ip, None)
+
+    def record(self, client_ip, lane, nbytes):
+        """Account bytes sent outside ``shape`` (e.g. small JSON responses)."""
+        self.lane_meters[lane].record(nbytes)
+        self._client(client_ip)[1].record(nbytes)
+
+    def shape(self, iterable, client_ip, lane):
+        """Yield chunks from ``iterable``, throttled according to ``lane``."""
+        bucket, meter = self._client(client_ip)
+        lane_meter = self.lane_meters[lane]
+        with self.lock:
+            self.active_streams[lane] += 1
+        try:
+            for chunk in iterable:
+                if lane == 'bulk':
+                    bucket.consume(len(chunk))
+                    self.global_bucket.consume(len(chunk))
+                lane_meter.record(len(chunk))
+                meter.record(len(chunk))
+                yield chunk
+        finally:
+            with self.lock:
+                self.active_streams[lane] -= 1
+            close = getattr(iterable, 'close', None)
+            if close:
+                close()
+
+    def stats(self):
+        with self.lock:
+            clients = dict(self.client_meters)
+            active = dict(self.active_streams)
+        return {
+            'limits': {
+                'global_rate': self.global_bucket.rate,
+                'client_rate': self.client_rate,
+                'bypass_size': EGRESS_BYPASS_SIZE,
+            },
+            'lanes': {lane: {**meter.stats(), 'active_streams': active[lane]}
+                      for lane, meter in self.lane_meters.items()},
+            'clients': self._client_summary(clients.values()),
+        }
+
+    @staticmethod
+    def _client_summary(meters):
+        """Per-client rates as percentiles; /api/metrics is public, so no IPs."""
+        rates = sorted(meter.stats()['rate'] for meter in meters)
+        if not rates:
+            return {'count': 0}
+
+        def pick(q):
+            return rates[min(len(rates) - 1, int(q * len(rates)))]
+        return {'count': len(rates), 'active': sum(1 for r in rates if r),
+                'rate_p50': pick(0.5), 'rate_p95': pick(0.95), 'rate_max': rates[-1]}
+
+
+egress_shaper = EgressShaper(EGRESS_GLOBAL_RATE, EGRESS_CLIENT_RATE, EGRESS_BURST_SECONDS)
+
+@app.after_request
+def meter_egress(response):
+    """Count non-file responses in the interactive lane."""
+    if not getattr(g, 'egress_shaped', False) and response.content_length:
+        egress_shaper.record(get_client_ip(), 'interactive', response.content_length)
+    return response
+
+# ============================================================================
+# CACHE REVALIDATION (stale-while-revalidate)
+# ============================================================================
+
+def _build_analyze_payload(info):
+    """Summarize extracted info into the /api/analyze response."""
+    # Extract available formats
+    formats = []
+    if 'formats' in info and info['formats']:
+        seen_qualities = set()
+        for f in info['formats']:
+            height = f.get('height')
+            if height and isinstance(height, int):
+                quality_label = f"{height}p"
+                if quality_label not in seen_qualities:
+                    filesize = f.get('filesize') or f.get('filesize_approx')
+                    formats.append({
+                        'quality': quality_label,
+                        'height': height,
+                        'ext': f.get('ext', 'mp4'),
+                        'filesize': filesize,
+                        'format_id': f.get('format_id')
+                    })
+                    seen_qualities.add(quality_label)
+
+    # Sort formats by quality (highest first) - ensure height is valid
+    formats.sort(key=lambda x: x.get('height', 0), reverse=True)
+
+    # Sanitize title to prevent XSS
+    title = sanitize_text(info.get('title', 'Unknown Title'))
+    description = sanitize_text(info.get('description', ''))[:200]
+    if description and len(info.get('description', '')) > 200:
+        description += '...'
+
+    return {
+        'success': True,
+        'title': title,
+        'thumbnail': info.get('thumbnail', ''),
+        'duration': info.get('duration', 0),
+        'uploader': sanitize_text(info.get('uploader', 'Unknown')),
+        'view_count': info.get('view_count', 0),
+        'formats': formats[:6],  # Return top 6 quality options
+        'description': description
+    }
+
+def _build_formats_payload(info):
+    """Split extracted formats into the /api/formats response."""
+    # Organize formats by quality
+    video_formats = []
+    audio_formats = []
+
+    for f in info.get('formats', []):
+        format_info = {
+            'format_id': f.get('format_id'),
+            'ext': f.get('ext'),
+            'quality': f.get('format_note', 'Unknown'),
+            'filesize': f.get('filesize') or f.get('filesize_approx'),
+            'tbr': f.get('tbr')
+        }
+
+        if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
+            format_info['type'] = 'video+audio'
+            format_info['resolution'] = f"{f.get('height')}p" if f.get('height') else 'Unknown'
+            video_formats.append(format_info)
+        elif f.get('vcodec') != 'none':
+            format_info['type'] = 'video'
+            format_info['resolution'] = f"{f.get('height')}p" if f.get('height') else 'Unknown'
+            video_formats.append(format_info)
+        elif f.get('acodec') != 'none':
+            format_info['type'] = 'audio'
+            format_info['abr'] = f.get('abr')
+            audio_formats.append(format_info)
+
+    return {
+        'success': True,
+        'video_formats': video_formats,
+        'audio_formats': audio_formats
+    }
+
+def _refresh_analysis(url):
+    info = _extract_info_with_ydl('analyze', url, timeout=ANALYZE_TIMEOUT)
+    analyze_cache[url] = (time.time(), _build_analyze_payload(info))
+
+def _refresh_formats(url):
+    info = _extract_info_with_ydl('formats', url, timeout=ANALYZE_TIMEOUT)
+    formats_cache[url] = (time.time(), _build_formats_payload(info))
+
+# scope -> (cache dict, refresh function, negative-cache payload prefix, status)
+CACHE_SCOPES = {
+    'analyze': (analyze_cache, _refresh_analysis, 'Failed to analyze video', 400),
+    'formats': (formats_cache, _refresh_formats, 'Failed to get formats', 500),
+}
+
+
+class CacheRevalidator:
+    """Runs at most one background refresh per stale entry, within a rate budget."""
+
+    def __init__(self, rate, burst, workers):
+        self.budget = TokenBucket(rate, burst)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='revalidate')
+        self.inflight = set()  # (scope, url)
+        self.lock = threading.Lock()
+        self.counters = {'scheduled': 0, 'refreshed': 0, 'failed': 0, 'throttled': 0}
+
+    def schedule(self, scope, url):
+        """Start a refresh unless one is running or the budget is spent."""
+        with self.lock:
+            if (scope, url) in self.inflight:
+                return False
+            if not self.budget.try_consume():
+                self.counters['throttled'] += 1
+                return False
+            self.inflight.add((scope, url))
+            self.counters['scheduled'] += 1
+        self.executor.submit(self._refresh, scope, url)
+        return True
+
+    def _refresh(self, scope, url):
+        cache, refresh, error_prefix, status = CACHE_SCOPES[scope]
+        try:
+            refresh(url)
+            logger.info(f"Revalidated {scope} cache for {url[:100]}")
+            with self.lock:
+                self.counters['refreshed'] += 1
+        except Exception as e:
+            with self.lock:
+                self.counters['failed'] += 1
+            if classify_extraction_error(e) == 'permanent':
+                # The video is gone; stop serving the stale copy
+                cache.pop(url, None)
+                negative_cache.put(scope, canonical_video_key(url), 'permanent',
+                                   {'error': f'{error_prefix}: {str(e)}'}, status)
+            logger.warning(f"Revalidation of {scope} cache failed for {url[:100]}: {e}")
+        finally:
+            with self.lock:
+                self.inflight.discard((scope, url))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'inflight': len(self.inflight),
+                'entries': {scope: len(spec[0]) for scope, spec in CACHE_SCOPES.items()},
+                **self.counters,
+            }
+
+
+cache_revalidator = CacheRevalidator(CACHE_REVALIDATE_RATE, CACHE_REVALIDATE_BURST,
+                                     CACHE_REVALIDATE_WORKERS)
+
+def cache_lookup(scope, url):
+    """Return (payload, age, stale) for a servable entry, or None.
+
+    Entries older than CACHE_TTL are still served until CACHE_HARD_TTL,
+    with a background refresh scheduled.
+    """
+    cached = CACHE_SCOPES[scope][0].get(url)
+    if not cached:
+        return None
+    ts, payload = cached
+    age = time.time() - ts
+    if age >= CACHE_HARD_TTL:
+        return None
+    stale = age >= CACHE_TTL
+    if stale:
+        cache_revalidator.schedule(scope, url)
+    return payload, age, stale
+
+def cache_peek(scope, url):
+    """Whether a request for ``url`` would be answered from a cache."""
+    cached = CACHE_SCOPES[scope][0].get(url)
+    if cached and time.time() - cached[0] < CACHE_HARD_TTL:
+        return True
+    return negative_cache.peek(scope, canonical_video_key(url))
+
+def cached_response(payload, age, stale):
+    """JSON response for a cache hit, carrying its age."""
+    response = jsonify(payload)
+    response.headers['Age'] = str(int(age))
+    response.headers['X-Cache'] = 'STALE' if stale else 'HIT'
+    return response
+
+# ============================================================================
+# TWO-PHASE (LITE) ANALYSIS
+# ============================================================================
+
+def _analyze_url(url, video_key):
+    """Fully extract ``url`` with retries; returns ``(payload, status)``.
+
+    Successes are stored in analyze_cache, failures in the negative cache.
+    """
+    # Retry mechanism for anti-bot issues
+    max_retries = 5
+    info = None
+    for attempt in range(max_retries + 1):
+        try:
+            # Use thread-based extraction with timeout to avoid hanging the request
+            info = _extract_info_with_ydl('analyze', url, timeout=ANALYZE_TIMEOUT)
+            break  # Success, exit retry loop
+        except yt_dlp.utils.DownloadError as e:
+            msg = str(e)
+            if "Sign in to confirm you're not a bot" in msg or 'not a bot' in msg:
+                if attempt < max_retries:
+                    wait_time = (2 ** attempt) + (attempt * 2)  # More aggressive backoff
+                    logger.warning(f"Anti-bot challenge on attempt {attempt + 1}, waiting {wait_time}s before retry...")
+                    time.sleep(wait_time)
+                    continue
+                else:
+                    logger.error(f"YouTube anti-bot challenge persisted after {max_retries + 1} attempts")
+                    return record_failure('analyze', video_key, e, {
+                        'error': 'YouTube is blocking automated requests for this video',
+                        'message': 'This video is temporarily unavailable. Please try again later or use a different video.',
+                        'technical': 'Anti-bot verification required'
+                    }, 503)  # Service Unavailable
+            else:
+                # Other download errors, don't retry
+                logger.exception(f"Download error: {e}")
+                return record_failure('analyze', video_key, e,
+                                      {'error': f'Failed to analyze video: {str(e)}'}, 400)
+        except TimeoutError as e:
+            # Treat extraction timeouts as transient and retry with backoff
+            if attempt < max_retries:
+                wait_time = (2 ** attempt) + 2
+                logger.warning(f"Extraction timeout on attempt {attempt + 1}, waiting {wait_time}s before retry...")
+                time.sleep(wait_time)
+                continue
+            else:
+                logger.error(f"Extraction timed out after {max_retries + 1} attempts: {e}")
+                return record_failure('analyze', video_key, e,
+                                      {'error': 'Video analysis timed out. Please try again later.'}, 504)
+        except Exception as e:
+            if attempt < max_retries:
+                wait_time = 2 ** attempt
+                logger.warning(f"Unexpected error on attempt {attempt + 1}, waiting {wait_time}s: {e}")
+                time.sleep(wait_time)
+                continue
+            else:
+                logger.exception(f"Unexpected error analyzing video: {e}")
+                return record_failure('analyze', video_key, e,
+                                      {'error': 'Failed to analyze video. Please check the URL and try again.'}, 500)
+
+    # Check if we got info after all retries
+    if info is None:
+        return {'error': 'Failed to analyze video after multiple attempts.'}, 500
+
+    try:
+        payload = _build_analyze_payload(info)
+        logger.info(f"Successfully analyzed: {payload['title']}")
+        # Store in cache
+        analyze_cache[url] = (time.time(), payload)
+        return payload, 200
+
+    except Exception as e:
+        logger.exception(f"Error processing video info: {e}")
+        return {'error': 'Failed to process video information. Please try again.'}, 500
+
+
+META_TAG_RE = re.compile(r'<(?:meta|link)\s[^>]*>', re.I)
+TAG_ATTR_RE = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+ISO_DURATION_RE = re.compile(r'^P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?$', re.I)
+LENGTH_SECONDS_RE = re.compile(rb'"lengthSeconds"\s*:\s*"(\d+)"')
+TITLE_RE = re.compile(r'<title[^>]*>([^<]*)</title>', re.I)
+
+def _parse_duration(value):
+    """Seconds from '213', '213.5' or an ISO 8601 duration like 'PT3M33S'."""
+    value = (value or '').strip()
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    match = ISO_DURATION_RE.match(value)
+    if not match or not any(match.groups()):
+        return None
+    days, hours, minutes, seconds = (float(x) if x else 0 for x in match.groups())
+    return int(days * 86400 + hours * 3600 + minutes * 60 + seconds)
+
+def _parse_page_metadata(page):
+    """Title, thumbnail, duration and uploader from OpenGraph/microdata tags."""
+    text = page.decode('utf-8', errors='replace')
+    meta, links = {}, {}
+    for tag in META_TAG_RE.findall(text):
+        attrs = {m.group(1).lower(): html.unescape(m.group(2) if m.group(2) is not None else m.group(3))
+                 for m in TAG_ATTR_RE.finditer(tag)}
+        key = (attrs.get('property') or attrs.get('name') or attrs.get('itemprop') or '').lower()
+        value = attrs.get('content') or attrs.get('href')
+        if key and value:
+            target = links if tag[:5].lower() == '<link' else meta
+            target.setdefault(key, value)
+
+    def first(*keys, source=meta):
+        return next((source[k] for k in keys if source.get(k)), None)
+
+    title = first('og:title', 'twitter:title', 'name', 'title')
+    if not title:
+        match = TITLE_RE.search(text)
+        title = html.unescape(match.group(1)).strip() if match else None
+    if not title:
+        return None
+    duration = _parse_duration(first('og:video:duration', 'video:duration', 'duration'))
+    if duration is None:
+        match = LENGTH_SECONDS_RE.search(page)
+        duration = int(match.group(1)) if match else None
+    return {
+        'title': sanitize_text(title),
+        'thumbnail': first('og:image', 'twitter:image', 'thumbnailurl') or '',
+        'duration': duration or 0,
+        # YouTube puts the channel name on <link itemprop="name"> inside its author block
+        'uploader': sanitize_text(first('name', source=links) or first('author', 'og:site_name') or 'Unknown'),
+    }
+
+def fetch_lite_metadata(url):
+    """Basic metadata from the page's embedded tags, without yt-dlp.
+
+    Returns None when the URL isn't an HTML page with usable metadata.
+    """
+    headers = {'User-Agent': USER_AGENT, 'Accept': 'text/html', 'Accept-Language': 'en-US,en;q=0.9'}
+    # Redirects are followed by hand so every hop is validated and pinned
+    for _ in range(LITE_MAX_REDIRECTS + 1):
+        if not is_valid_url(url):
+            return None
+        with pin_url_host(url), requests.get(url, headers=headers, stream=True, allow_redirects=False,
+                                             timeout=LITE_FETCH_TIMEOUT) as resp:
+            if resp.is_redirect:
+                url = urljoin(url, resp.headers['Location'])
+                continue
+            resp.raise_for_status()
+            if 'html' not in resp.headers.get('Content-Type', ''):
+                return None
+            page = bytearray()
+            for chunk in resp.iter_content(64 * 1024):
+                page += chunk
+                if len(page) >= LITE_MAX_BYTES:
+                    break
+        return _parse_page_metadata(bytes(page))
+    return None
+
+
+class AnalysisBacklogFull(Exception):
+    """Too many background analyses are already running or queued."""
+
+
+class PendingAnalysis:
+    """A full analysis running in the background for a lite request."""
+
+    def __init__(self, analysis_id, url):
+        self.id = analysis_id
+        self.url = url
+        self.payload = None
+        self.status = None  # HTTP status once finished
+        self.finished_at = None
+        self.cond = threading.Condition()
+
+    def finish(self, payload, status):
+        with self.cond:
+            self.payload, self.status = payload, status
+            self.finished_at = time.time()
+            self.cond.notify_all()
+
+    def wait(self, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.status is not None, timeout)
+            return self.payload, self.status
 
-# CORS configuration with more security (allow GH Pages, Render, and local dev)
-CORS(app, resources={
-    r"/api/*": {
-        # Use regex patterns for origins to properly match ports/subdomains
-        "origins": [
-            r"https?://localhost(:\d+)?",
-            r"https?://127\.0\.0\.1(:\d+)?",
-            r"https://iwtbg-8\.github\.io",
-            r"https://.*\.onrender\.com"
-        ],
-        "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type"]
-    }
-})
 
-# Configuration
-MAX_FILESIZE = 20 * 1024 * 1024 * 1024  # 20GB max file size
-ALLOWED_DOMAINS = []  # Empty means all domains allowed
-DOWNLOAD_DIR = os.path.join(os.getcwd(), 'downloads')
-CACHE_TTL = 24 * 3600  # 24 hours cache (increased)
-RATE_LIMIT_WINDOW = 10 * 60  # 10 minutes window (for 1000 requests)
-RATE_LIMIT_MAX = 1000  # Max 1000 requests per IP per 10 minutes (very generous)
+def _run_pending_analysis(pending, video_key):
+    try:
+        pending.finish(*_analyze_url(pending.url, video_key))
+    except Exception as e:
+        logger.exception(f"Background analysis failed: {e}")
+        pending.finish({'error': 'Failed to analyze video. Please check the URL and try again.'}, 500)
 
-# Timeouts
-ANALYZE_TIMEOUT = 30  # seconds timeout for yt-dlp extract_info calls
+def start_lite_analysis(url, video_key):
+    """Return lite metadata and start (or join) the full analysis, or None.
 
-# In-memory caches and rate limit storage
-analyze_cache = {}  # url -> (timestamp, data)
-formats_cache = {}  # url -> (timestamp, data)
-rate_limit_map = {}  # ip -> deque[timestamps]
+    Raises AnalysisBacklogFull when a new analysis would exceed ANALYZE_MAX_PENDING.
+    """
+    try:
+        lite = fetch_lite_metadata(url)
+    except Exception as e:
+        logger.info(f"Lite metadata unavailable for {url[:100]}: {e}")
+        lite = None
+    if not lite:
+        return None
 
-# Create downloads directory if it doesn't exist
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
-    logger.info(f"Created download directory: {DOWNLOAD_DIR}")
+    analysis_id = f"{cluster.tag}{hashlib.md5(url.encode()).hexdigest()[:16]}"
+    now = time.time()
+    with pending_analyses_lock:
+        for stale_id in [i for i, p in pending_analyses.items()
+                         if p.finished_at and now - p.finished_at > ANALYZE_RESULT_RETENTION]:
+            del pending_analyses[stale_id]
+        pending = pending_analyses.get(analysis_id)
+        # A finished failure is retried; the negative cache keeps that cheap
+        start = pending is None or (pending.status is not None and pending.status != 200)
+        if start:
+            # The executor queue is unbounded and bypasses the expensive limiter
+            backlog = sum(1 for p in pending_analyses.values() if p.status is None)
+            if backlog >= ANALYZE_MAX_PENDING:
+                raise AnalysisBacklogFull()
+            pending = pending_analyses[analysis_id] = PendingAnalysis(analysis_id, url)
+    if start:
+        analyze_executor.submit(_run_pending_analysis, pending, video_key)
+
+    return {
+        'success': True,
+        'lite': True,
+        **lite,
+        'formats': [],
+        'formats_pending': True,
+        'analysis_id': analysis_id,
+        'formats_url': f'/api/analyze/{analysis_id}',
+    }
 
 # ============================================================================
-# UTILITY FUNCTIONS
+# CLUSTER MODE (consistent-hash sharding)
 # ============================================================================
 
-def is_valid_url(url):
-    """Validate URL format and check for suspicious patterns"""
-    try:
-        result = urlparse(url)
-        
-        # Check basic URL structure
-        if not all([result.scheme, result.netloc]):
-            return False
-        
-        # Only allow http and https
-        if result.scheme not in ['http', 'https']:
-            return False
-        
-        # Block localhost and private IPs to prevent SSRF
-        blocked_hosts = ['localhost', '127.0.0.1', '0.0.0.0', '::1']
-        hostname = result.netloc.split(':')[0].lower()
-        
-        if hostname in blocked_hosts:
-            logger.warning(f"Blocked localhost/private IP: {result.netloc}")
-            return False
-        
-        # Check for private IP ranges (basic check)
-        if (hostname.startswith('192.168.') or 
-            hostname.startswith('10.') or 
-            hostname.startswith('172.16.') or
-            hostname.startswith('172.17.') or
-            hostname.startswith('172.18.') or
-            hostname.startswith('172.19.') or
-            hostname.startswith('172.20.') or
-            hostname.startswith('172.21.') or
-            hostname.startswith('172.22.') or
-            hostname.startswith('172.23.') or
-            hostname.startswith('172.24.') or
-            hostname.startswith('172.25.') or
-            hostname.startswith('172.26.') or
-            hostname.startswith('172.27.') or
-            hostname.startswith('172.28.') or
-            hostname.startswith('172.29.') or
-            hostname.startswith('172.30.') or
-            hostname.startswith('172.31.')):
-            logger.warning(f"Blocked private IP range: {result.netloc}")
-            return False
-        
-        return True
-    except Exception as e:
-        logger.error(f"URL validation error: {e}")
-        return False
+class HashRing:
+    """Consistent-hash ring with ``vnodes`` virtual nodes per node."""
 
-def sanitize_text(text):
-    """Sanitize text to prevent XSS and other injection attacks"""
-    if not text:
-        return ""
-    
-    # Remove potentially dangerous characters
-    text = str(text)
-    text = re.sub(r'[<>"\']', '', text)
-    text = text.strip()
-    
-    return text[:500]  # Limit length
+    def __init__(self, nodes, vnodes=CLUSTER_VNODES):
+        points = []
+        for node in nodes:
+            for i in range(vnodes):
+                points.append((self._hash(f"{node}#{i}"), node))
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
 
-def sanitize_filename(filename):
-    """Sanitize filename to prevent directory traversal and ensure safety"""
-    # Remove any directory components
-    filename = os.path.basename(filename)
-    
-    # Remove any dangerous characters
-    filename = re.sub(r'[^\w\s\-\.]', '', filename)
-    
-    # Limit length
-    if len(filename) > 255:
-        name, ext = os.path.splitext(filename)
-        filename = name[:250] + ext
-    
-    return filename
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
 
-def get_client_ip():
-    """Get client IP considering proxies (X-Forwarded-For)."""
-    xff = request.headers.get('X-Forwarded-For', '')
-    if xff:
-        # Take the first IP in the list
-        return xff.split(',')[0].strip()
-    return request.remote_addr or 'unknown'
+    def owner(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
 
-def is_rate_limited(ip):
-    """Basic fixed-window rate limiter using a sliding deque."""
-    now = time.time()
-    dq = rate_limit_map.get(ip)
-    if dq is None:
-        dq = deque()
-        rate_limit_map[ip] = dq
-    # Evict old timestamps
-    while dq and now - dq[0] > RATE_LIMIT_WINDOW:
-        dq.popleft()
-    if len(dq) >= RATE_LIMIT_MAX:
-        return True
-    dq.append(now)
-    return False
 
+class Cluster:
+    """Routes each video key to its owner node.
 
-def _extract_info_with_ydl(ydl_opts, url, timeout=ANALYZE_TIMEOUT):
-    """Run yt_dlp.extract_info in a thread with a timeout to avoid hangs.
+    The owner extracts, caches and downloads; other nodes forward requests
+    to it and keep short-lived copies of the metadata it returns. Job IDs
+    and file names made on a cluster node carry its tag (``n<index>-``),
+    so any node can send follow-up requests to the right place.
+    """
 
-    Returns the infodict on success or raises the underlying exception.
+    TAG_RE = re.compile(r'^(?:download_)?n(\d+)-')
+    RELAY_HEADERS = ('Content-Type', 'Content-Length', 'Content-Disposition', 'Content-Range',
+                     'Accept-Ranges', 'Cache-Control', 'Retry-After', 'Location', 'Age',
+                     'X-Cache', 'X-Negative-Cache', 'X-Accel-Buffering', 'X-Direct-URL-Expires')
+
+    def __init__(self, nodes, self_node, vnodes=CLUSTER_VNODES):
+        self.nodes = [n.strip().rstrip('/') for n in nodes if n.strip()]
+        self.self_node = self_node.strip().rstrip('/')
+        self.enabled = len(self.nodes) > 1 and self.self_node in self.nodes
+        if self.nodes and not self.enabled:
+            logger.warning(f"Cluster mode disabled: this node ({self.self_node or 'unset'}) "
+                           f"must be one of {len(self.nodes)} listed nodes")
+        self.tag = f"n{self.nodes.index(self.self_node)}-" if self.enabled else ''
+        self.ring = HashRing(self.nodes, vnodes) if self.enabled else None
+        self.copies = {}  # (scope, url) -> (expires, status, body, content type)
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=32))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=32))
+        self.counters = {'forwarded': 0, 'copies_served': 0, 'relayed': 0, 'owner_unavailable': 0,
+                         'owner_timeouts': 0}
+
+    @classmethod
+    def from_config(cls):
+        """Build from CLUSTER_CONFIG if set, else CLUSTER_NODES/CLUSTER_SELF."""
+        nodes, self_node = CLUSTER_NODES, CLUSTER_SELF
+        if CLUSTER_CONFIG:
+            with open(CLUSTER_CONFIG) as fh:
+                config = json.load(fh)
+            nodes = config.get('nodes', nodes)
+            self_node = CLUSTER_SELF or config.get('self', '')
+        return cls(nodes, self_node)
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def owner_for(self, url):
+        """The node owning ``url``, or None if this node should handle it."""
+        if not self.enabled or request.headers.get(CLUSTER_HEADER):
+            return None
+        owner = self.ring.owner(canonical_video_key(url))
+        return None if owner == self.self_node else owner
+
+    def node_for_tag(self, name):
+        """The other node that created a tagged job ID or file name, if any."""
+        match = self.TAG_RE.match(name) if self.enabled else None
+        if not match or request.headers.get(CLUSTER_HEADER):
+            return None
+        index = int(match.group(1))
+        node = self.nodes[index] if index < len(self.nodes) else None
+        return None if node == self.self_node else node
+
+    def _relay(self, upstream, node, stream=False, lane=None):
+        """Turn an upstream ``requests`` response into a Flask response."""
+        headers = {k: upstream.headers[k] for k in self.RELAY_HEADERS if k in upstream.headers}
+        headers['X-Cluster-Node'] = node
+        if stream:
+            body = upstream.iter_content(chunk_size=None)
+            if lane:
+                body = egress_shaper.shape(body, get_client_ip(), lane)
+                g.egress_shaped = True
+            response = Response(body, status=upstream.status_code, headers=headers)
+            response.call_on_close(upstream.close)
+            return response
+        return Response(upstream.content, status=upstream.status_code, headers=headers)
+
+    def forward(self, scope, url, owner, body):
+        """POST ``body`` to the owner; returns a response, or None to serve locally."""
+        copy_key = (scope, url)
+        with self.lock:
+            cached = self.copies.get(copy_key)
+            if cached and cached[0] <= time.time():
+                del self.copies[copy_key]
+                cached = None
+        if cached:
+            self._count('copies_served')
+            _, status, content, content_type = cached
+            return Response(content, status=status, headers={'Content-Type': content_type,
+                                                             'X-Cluster-Copy': owner})
+        headers = {CLUSTER_HEADER: self.self_node, 'X-Forwarded-For': get_client_ip()}
+        # A synchronous download holds the request for the whole transfer
+        timeout = (5, None) if scope == 'download' else (5, CLUSTER_FORWARD_TIMEOUT)
+        try:
+            # Redirects (e.g. delivery=redirect) go back to the client untouched
+            upstream = self.session.post(f"{owner}{request.path}", json=body, headers=headers,
+                                         allow_redirects=False, timeout=timeout)
+        except requests.ConnectionError as e:  # includes ConnectTimeout
+            self._count('owner_unavailable')
+            logger.warning(f"Cluster owner {owner} unavailable for {scope}, serving locally: {e}")
+            return None
+        except requests.RequestException as e:
+            # The owner accepted the request and is still working on it (slow
+            # anti-bot extractions); running it here too would double the work
+            self._count('owner_timeouts')
+            logger.warning(f"Cluster owner {owner} did not answer {scope} in time: {e}")
+            timed_out = isinstance(e, requests.Timeout)
+            response = jsonify({'error': 'This video is taking longer than expected. Please retry shortly.'
+                                if timed_out else 'Upstream server error. Please retry shortly.'})
+            response.status_code = 504 if timed_out else 502
+            response.headers['Retry-After'] = str(CLUSTER_RETRY_AFTER)
+            return response
+        self._count('forwarded')
+        # Lite responses are superseded within seconds; never copy them
+        if scope in ('analyze', 'formats') and upstream.status_code == 200 and not body.get('lite'):
+            now = time.time()
+            with self.lock:
+                if len(self.copies) >= 1024:
+                    for key in [k for k, v in self.copies.items() if v[0] <= now]:
+                        del self.copies[key]
+                self.copies[copy_key] = (now + CLUSTER_COPY_TTL, 200, upstream.content,
+                                         upstream.headers.get('Content-Type', 'application/json'))
+        return self._relay(upstream, owner)
+
+    def proxy_get(self, node, lane=None, slot=None):
+        """Relay the current GET request to ``node``, streaming the body.
+
+        File bodies pass through the egress shaper in ``lane``. ``slot`` is a
+        semaphore the caller acquired for the relayed stream; it is released
+        when the response closes. The request leaves the concurrency limiter
+        first: the owner admits the work, this node only holds a thread.
+        """
+        leave_concurrency_limit()
+        headers = {CLUSTER_HEADER: self.self_node, 'X-Forwarded-For': get_client_ip()}
+        for name in ('Range', 'Last-Event-ID', 'If-None-Match', 'If-Modified-Since'):
+            if name in request.headers:
+                headers[name] = request.headers[name]
+        try:
+            upstream = self.session.get(f"{node}{request.full_path.rstrip('?')}", headers=headers,
+                                        stream=True, allow_redirects=False,
+                                        timeout=(5, CLUSTER_FORWARD_TIMEOUT))
+        except requests.RequestException as e:
+            self._count('owner_unavailable')
+            logger.warning(f"Cluster node {node} unavailable: {e}")
+            if slot:
+                slot.release()
+            return jsonify({'error': 'The server holding this download is unavailable. Please try again.'}), 502
+        self._count('relayed')
+        response = self._relay(upstream, node, stream=True, lane=lane)
+        if slot:
+            response.call_on_close(slot.release)
+        return response
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'self': self.self_node or None,
+                'nodes': self.nodes,
+                'local_copies': len(self.copies),
+                **self.counters,
+            }
+
+
+cluster = Cluster.from_config()
+
+# ============================================================================
+# ADAPTIVE CONCURRENCY LIMITS & LOAD SHEDDING
+# ============================================================================
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight requests, driven by observed latency.
+
+    A request that finishes under ``target_latency`` while the limit was at
+    least half used raises the limit by 1/limit (about +1 per full window);
+    a slower one, or an upstream timeout, cuts it by CONCURRENCY_BACKOFF at
+    most once per CONCURRENCY_DECREASE_INTERVAL. Requests over the limit are
+    rejected at once rather than queueing behind the backlog.
     """
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-        future = ex.submit(_run_ydl_extract, ydl_opts, url)
+
+    def __init__(self, name, initial, minimum, maximum, target_latency):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self._last_decrease = 0.0
+        self.latency_ewma = None
+        self.counters = {'admitted': 0, 'rejected': 0, 'increases': 0, 'decreases': 0}
+
+    def try_acquire(self):
+        """Admit one request; returns a token for ``release`` or None."""
+        with self.lock:
+            if self.inflight >= int(self.limit):
+                self.counters['rejected'] += 1
+                return None
+            self.inflight += 1
+            self.counters['admitted'] += 1
+            return time.monotonic(), self.inflight >= self.limit / 2
+
+    def release(self, token, overloaded=False, sample_latency=True):
+        """Finish a request and adjust the limit from its outcome."""
+        started, saturated = token
+        now = time.monotonic()
+        latency = now - started
+        with self.lock:
+            self.inflight -= 1
+            if sample_latency:
+                self.latency_ewma = latency if self.latency_ewma is None \
+                    else 0.9 * self.latency_ewma + 0.1 * latency
+            if overloaded or (sample_latency and latency > self.target_latency):
+                if now - self._last_decrease >= CONCURRENCY_DECREASE_INTERVAL:
+                    self.limit = max(self.minimum, self.limit * CONCURRENCY_BACKOFF)
+                    self._last_decrease = now
+                    self.counters['decreases'] += 1
+            elif sample_latency and saturated and self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                self.counters['increases'] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'limit': int(self.limit),
+                'inflight': self.inflight,
+                'min': self.minimum,
+                'max': self.maximum,
+                'target_latency': self.target_latency,
+                'latency_ewma': round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+                **self.counters,
+            }
+
+
+concurrency_limiters = {name: AdaptiveConcurrencyLimiter(name, *spec)
+                        for name, spec in CONCURRENCY_BUDGETS.items()}
+
+# endpoint -> cache scope that can answer it cheaply (None: always expensive)
+EXPENSIVE_ENDPOINTS = {
+    'analyze_video': 'analyze',
+    'get_formats': 'formats',
+    'download_video': None,
+}
+
+def _concurrency_budget():
+    """Pick the limiter for the current request, or None if it is exempt."""
+    if not request.path.startswith('/api') or request.method == 'OPTIONS':
+        return None
+    if request.endpoint not in EXPENSIVE_ENDPOINTS or request.method != 'POST':
+        return 'cheap'
+    scope = EXPENSIVE_ENDPOINTS[request.endpoint]
+    url = (request.get_json(silent=True) or {}).get('url')
+    if scope and isinstance(url, str):
         try:
-            return future.result(timeout=timeout)
-        except concurrent.futures.TimeoutError:
-            future.cancel()
-            raise TimeoutError(f"yt-dlp extract_info timed out after {timeout}s")
+            if cache_peek(scope, url):
+                return 'cheap'
+        except ValueError:
+            pass  # malformed URL; the route rejects it
+    return 'expensive'
 
+@app.before_request
+def admit_request():
+    """Shed load above the adaptive concurrency limit with 503 + Retry-After."""
+    budget = _concurrency_budget()
+    if budget is None:
+        return None
+    if budget == 'expensive' and shutdown_event.is_set():
+        response = jsonify({'error': 'Server is restarting. Please retry shortly.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SHUTDOWN_RETRY_AFTER)
+        return response
+    token = concurrency_limiters[budget].try_acquire()
+    if token is None:
+        logger.warning(f"Shedding {request.method} {request.path}: {budget} concurrency limit reached")
+        response = jsonify({'error': 'Server is busy. Please retry shortly.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(CONCURRENCY_RETRY_AFTER)
+        return response
+    g.concurrency_token = (budget, token)
+    return None
 
-def _run_ydl_extract(ydl_opts, url):
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        return ydl.extract_info(url, download=False)
+@app.after_request
+def note_response_status(response):
+    # A replayed cached failure (even an anti-bot 503) did no upstream work,
+    # so it must not count as an overload signal
+    if 'X-Negative-Cache' not in response.headers:
+        g.response_status = response.status_code
+    return response
+
+def leave_concurrency_limit():
+    """Give back this request's limiter slot before a long wait.
+
+    For work admitted elsewhere (e.g. by the download scheduler): the wait
+    neither loads this budget nor says anything about its latency.
+    """
+    admitted = g.pop('concurrency_token', None)
+    if admitted is not None:
+        budget, token = admitted
+        concurrency_limiters[budget].release(token, sample_latency=False)
+
+@app.teardown_request
+def release_concurrency(exc):
+    admitted = g.pop('concurrency_token', None)
+    if admitted is None:
+        return
+    budget, token = admitted
+    # Upstream timeouts and unhandled errors count as overload
+    overloaded = exc is not None or g.get('response_status') in (503, 504)
+    concurrency_limiters[budget].release(token, overloaded)
 
 # ============================================================================
 # ROUTES
@@ -207,12 +3102,33 @@ def api_info():
             '/api/analyze': {
                 'methods': ['POST'],
                 'description': 'Analyze video URL',
-                'body': {'url': 'string (required)'}
+                'body': {'url': 'string (required)',
+                         'lite': 'boolean (optional, return page metadata at once and resolve formats in the background)'}
+            },
+            '/api/analyze/<analysis_id>': {
+                'methods': ['GET'],
+                'description': 'Full result of a lite analysis (202 while pending; ?wait=seconds to long-poll)'
             },
             '/api/download': {
                 'methods': ['POST'],
                 'description': 'Download video',
-                'body': {'url': 'string (required)', 'quality': 'string (e.g., "720p", "1080p")'}
+                'body': {'url': 'string (required)', 'quality': 'string (e.g., "720p", "1080p")',
+                         'audio_format': 'string (optional, "original", "m4a", "opus" or "mp3")',
+                         'async': 'boolean (optional, return a job_id immediately)',
+                         'delivery': 'string (optional, "proxy", "direct" or "redirect"; '
+                                     'falls back to proxy when the media URL needs headers, cookies or merging)'}
+            },
+            '/api/jobs/<job_id>': {
+                'methods': ['GET'],
+                'description': 'Download job status'
+            },
+            '/api/jobs/<job_id>/events': {
+                'methods': ['GET'],
+                'description': 'Live download progress (text/event-stream)'
+            },
+            '/api/jobs/<job_id>/file': {
+                'methods': ['GET'],
+                'description': 'Downloaded file; single-file formats stream while still downloading'
             },
             '/api/formats': {
                 'methods': ['POST'],
@@ -222,6 +3138,10 @@ def api_info():
             '/api/download-file/<filename>': {
                 'methods': ['GET'],
                 'description': 'Download the file'
+            },
+            '/api/metrics': {
+                'methods': ['GET'],
+                'description': 'Download queue, egress throughput and cache metrics'
             }
         }
     })
@@ -259,147 +3179,85 @@ def analyze_video():
         
         logger.info(f"Analyzing URL: {url[:100]}... (ip={client_ip})")
 
-        # Cache check
-        cached = analyze_cache.get(url)
+        # Cache check (stale entries are served while a refresh runs)
+        cached = cache_lookup('analyze', url)
         if cached:
-            ts, payload = cached
-            if time.time() - ts < CACHE_TTL:
-                logger.info("Returning cached analysis result")
-                return jsonify(payload)
+            logger.info("Returning cached analysis result")
+            return cached_response(*cached)
 
-        # yt-dlp options for extracting info only with proper headers
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'socket_timeout': 60,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'referer': 'https://www.youtube.com/',
-            'nocheckcertificate': True,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'web'],
-                    'skip': ['hls', 'dash', 'translated_subs']
-                }
-            },
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.9',
-                'Accept-Encoding': 'gzip, deflate',
-                'DNT': '1',
-            },
-            'noplaylist': True,
-            'geo_bypass': True,
-            'sleep_interval': 2,
-            'max_sleep_interval': 5,
-        }
+        video_key = canonical_video_key(url)
+        cached_failure = cached_failure_response('analyze', video_key)
+        if cached_failure is not None:
+            return cached_failure
 
-        # Retry mechanism for anti-bot issues
-        max_retries = 5
-        info = None
-        for attempt in range(max_retries + 1):
-            try:
-                # Use thread-based extraction with timeout to avoid hanging the request
-                info = _extract_info_with_ydl(ydl_opts, url, timeout=ANALYZE_TIMEOUT)
-                break  # Success, exit retry loop
-            except yt_dlp.utils.DownloadError as e:
-                msg = str(e)
-                if "Sign in to confirm you're not a bot" in msg or 'not a bot' in msg:
-                    if attempt < max_retries:
-                        wait_time = (2 ** attempt) + (attempt * 2)  # More aggressive backoff
-                        logger.warning(f"Anti-bot challenge on attempt {attempt + 1}, waiting {wait_time}s before retry...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        logger.error(f"YouTube anti-bot challenge persisted after {max_retries + 1} attempts")
-                        return jsonify({
-                            'error': 'YouTube is blocking automated requests for this video',
-                            'message': 'This video is temporarily unavailable. Please try again later or use a different video.',
-                            'technical': 'Anti-bot verification required'
-                        }), 503  # Service Unavailable
-                else:
-                    # Other download errors, don't retry
-                    logger.exception(f"Download error: {e}")
-                    return jsonify({'error': f'Failed to analyze video: {str(e)}'}), 400
-            except TimeoutError as e:
-                # Treat extraction timeouts as transient and retry with backoff
-                if attempt < max_retries:
-                    wait_time = (2 ** attempt) + 2
-                    logger.warning(f"Extraction timeout on attempt {attempt + 1}, waiting {wait_time}s before retry...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    logger.error(f"Extraction timed out after {max_retries + 1} attempts: {e}")
-                    return jsonify({'error': 'Video analysis timed out. Please try again later.'}), 504
-            except Exception as e:
-                if attempt < max_retries:
-                    wait_time = 2 ** attempt
-                    logger.warning(f"Unexpected error on attempt {attempt + 1}, waiting {wait_time}s: {e}")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    logger.exception(f"Unexpected error in analyze_video: {e}")
-                    return jsonify({'error': 'Failed to analyze video. Please check the URL and try again.'}), 500
+        # In cluster mode the owner node extracts (and caches) this video
+        owner = cluster.owner_for(url)
+        if owner:
+            relayed = cluster.forward('analyze', url, owner, data)
+            if relayed is not None:
+                return relayed
 
-        # Check if we got info after all retries
-        if info is None:
-            return jsonify({'error': 'Failed to analyze video after multiple attempts.'}), 500
+        # Two-phase analyze: page metadata now, formats in the background
+        if data.get('lite'):
+            try:
+                lite = start_lite_analysis(url, video_key)
+            except AnalysisBacklogFull:
+                logger.warning(f"Shedding lite analyze: {ANALYZE_MAX_PENDING} background analyses pending")
+                response = jsonify({'error': 'Server is busy. Please retry shortly.'})
+                response.status_code = 503
+                response.headers['Retry-After'] = str(CONCURRENCY_RETRY_AFTER)
+                return response
+            if lite is not None:
+                return jsonify(lite)
 
-        try:
-            # Process the extracted info
-            # Extract available formats
-            formats = []
-            if 'formats' in info and info['formats']:
-                seen_qualities = set()
-                for f in info['formats']:
-                    height = f.get('height')
-                    if height and isinstance(height, int):
-                        quality_label = f"{height}p"
-                        if quality_label not in seen_qualities:
-                            filesize = f.get('filesize') or f.get('filesize_approx')
-                            formats.append({
-                                'quality': quality_label,
-                                'height': height,
-                                'ext': f.get('ext', 'mp4'),
-                                'filesize': filesize,
-                                'format_id': f.get('format_id')
-                            })
-                            seen_qualities.add(quality_label)
-            
-            # Sort formats by quality (highest first) - ensure height is valid
-            formats.sort(key=lambda x: x.get('height', 0), reverse=True)
-            
-            # Sanitize title to prevent XSS
-            title = sanitize_text(info.get('title', 'Unknown Title'))
-            description = sanitize_text(info.get('description', ''))[:200]
-            if description and len(info.get('description', '')) > 200:
-                description += '...'
-            
-            logger.info(f"Successfully analyzed: {title}")
-            
-            payload = {
-                'success': True,
-                'title': title,
-                'thumbnail': info.get('thumbnail', ''),
-                'duration': info.get('duration', 0),
-                'uploader': sanitize_text(info.get('uploader', 'Unknown')),
-                'view_count': info.get('view_count', 0),
-                'formats': formats[:6],  # Return top 6 quality options
-                'description': description
-            }
-            # Store in cache
-            analyze_cache[url] = (time.time(), payload)
-            return jsonify(payload)
-            
-        except Exception as e:
-            logger.exception(f"Error processing video info: {e}")
-            return jsonify({'error': 'Failed to process video information. Please try again.'}), 500
+        payload, status = _analyze_url(url, video_key)
+        return jsonify(payload), status
     
     except Exception as e:
         logger.exception(f"Unexpected error in analyze_video outer handler: {e}")
         return jsonify({'error': 'Failed to analyze video. Please check the URL and try again.'}), 500
 
+@app.route('/api/analyze/<analysis_id>', methods=['GET'])
+def analysis_result(analysis_id):
+    """Poll for the full result of a lite analysis (optionally long-polling)"""
+    with pending_analyses_lock:
+        pending = pending_analyses.get(analysis_id)
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        wait = 0
+    wait = min(max(wait, 0), ANALYZE_POLL_MAX_WAIT) if math.isfinite(wait) else 0
+
+    if pending is None:
+        node = cluster.node_for_tag(analysis_id)  # started on another cluster node
+        if not node:
+            return jsonify({'error': 'Analysis not found'}), 404
+        if wait <= 0:
+            return cluster.proxy_get(node)
+        # A relayed long-poll holds a thread here too: same cap as local ones
+        if analysis_poll_slots.acquire(blocking=False):
+            return cluster.proxy_get(node, slot=analysis_poll_slots)
+        response = jsonify({'status': 'pending', 'analysis_id': analysis_id})
+        response.headers['Retry-After'] = '2'
+        return response, 202
+
+    # A blocked poll holds a worker thread but does no work: it leaves the
+    # cheap limiter and is capped on its own, answering at once when full
+    polled = wait > 0 and analysis_poll_slots.acquire(blocking=False)
+    if polled:
+        leave_concurrency_limit()
+        try:
+            payload, status = pending.wait(wait)
+        finally:
+            analysis_poll_slots.release()
+    else:
+        payload, status = pending.wait(0)
+    if status is None:
+        response = jsonify({'status': 'pending', 'analysis_id': analysis_id})
+        response.headers['Retry-After'] = '2' if wait > 0 and not polled else '1'
+        return response, 202
+    return jsonify(payload), status
+
 @app.route('/api/formats', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'])
 def get_formats():
     """Get all available formats for a video"""
@@ -429,74 +3287,34 @@ def get_formats():
         
         logger.info(f"Fetching formats for: {url[:100]}... (ip={client_ip})")
 
-        # Cache check
-        cached = formats_cache.get(url)
+        # Cache check (stale entries are served while a refresh runs)
+        cached = cache_lookup('formats', url)
         if cached:
-            ts, payload = cached
-            if time.time() - ts < CACHE_TTL:
-                logger.info("Returning cached formats result")
-                return jsonify(payload)
-        
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'socket_timeout': 60,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'referer': 'https://www.youtube.com/',
-            'nocheckcertificate': True,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'web'],
-                    'skip': ['hls', 'dash', 'translated_subs']
-                }
-            },
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.9',
-                'Accept-Encoding': 'gzip, deflate',
-            },
-            'noplaylist': True,
-            'geo_bypass': True,
-            'sleep_interval': 1,
-            'max_sleep_interval': 3,
-        }
+            logger.info("Returning cached formats result")
+            return cached_response(*cached)
+
+        video_key = canonical_video_key(url)
+        cached_failure = cached_failure_response('formats', video_key)
+        if cached_failure is not None:
+            return cached_failure
+
+        # In cluster mode the owner node extracts (and caches) this video
+        owner = cluster.owner_for(url)
+        if owner:
+            relayed = cluster.forward('formats', url, owner, data)
+            if relayed is not None:
+                return relayed
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+        with pin_url_host(url), ydl_pools['formats'].checkout() as ydl:
+            try:
+                info = ydl.extract_info(url, download=False)
+            except yt_dlp.utils.DownloadError as e:
+                logger.warning(f"Format extraction failed: {e}")
+                return remember_failure('formats', video_key, e,
+                                        {'error': f'Failed to get formats: {str(e)}'}, 500)
             
             try:
-                # Organize formats by quality
-                video_formats = []
-                audio_formats = []
-                
-                for f in info.get('formats', []):
-                    format_info = {
-                        'format_id': f.get('format_id'),
-                        'ext': f.get('ext'),
-                        'quality': f.get('format_note', 'Unknown'),
-                        'filesize': f.get('filesize') or f.get('filesize_approx'),
-                        'tbr': f.get('tbr')
-                    }
-                    
-                    if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-                        format_info['type'] = 'video+audio'
-                        format_info['resolution'] = f"{f.get('height')}p" if f.get('height') else 'Unknown'
-                        video_formats.append(format_info)
-                    elif f.get('vcodec') != 'none':
-                        format_info['type'] = 'video'
-                        format_info['resolution'] = f"{f.get('height')}p" if f.get('height') else 'Unknown'
-                        video_formats.append(format_info)
-                    elif f.get('acodec') != 'none':
-                        format_info['type'] = 'audio'
-                        format_info['abr'] = f.get('abr')
-                        audio_formats.append(format_info)
-                
-                payload = {
-                    'success': True,
-                    'video_formats': video_formats,
-                    'audio_formats': audio_formats
-                }
+                payload = _build_formats_payload(info)
                 # Store in cache
                 formats_cache[url] = (time.time(), payload)
                 return jsonify(payload)
@@ -519,16 +3337,25 @@ def download_video():
         return method_not_allowed(None)
     
     try:
+        # Rate limiting
+        client_ip = get_client_ip()
+        if is_rate_limited(client_ip):
+            return jsonify({'error': 'Too many requests. Please try again later.'}), 429
+
         data = request.get_json()
         if not data:
             return jsonify({'error': 'Invalid JSON data'}), 400
             
         url = data.get('url')
         quality = data.get('quality', '720p')
+        audio_format = data.get('audio_format', 'original')
         
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
+        if audio_format not in AUDIO_FORMATS:
+            return jsonify({'error': f"audio_format must be one of: {', '.join(AUDIO_FORMATS)}"}), 400
+        
         # Validate URL
         if not is_valid_url(url):
             return jsonify({'error': 'Invalid URL format'}), 400
@@ -539,113 +3366,193 @@ def download_video():
         if not re.match(r'^\d+p$|^audio$', quality):
             quality = '720p'
         
+        delivery = data.get('delivery', 'proxy')
+        if delivery not in DELIVERY_MODES:
+            return jsonify({'error': f"delivery must be one of: {', '.join(DELIVERY_MODES)}"}), 400
+
+        # In cluster mode the owner node downloads (and deduplicates) this video
+        owner = cluster.owner_for(url)
+        if owner:
+            if not data.get('async'):
+                leave_concurrency_limit()  # the owner admits and runs the download
+            relayed = cluster.forward('download', url, owner, data)
+            if relayed is not None:
+                return relayed
+
         logger.info(f"Downloading URL: {url[:100]}... Quality: {quality}")
-        
-        # Generate safe filename base
-        safe_filename = f"download_{hashlib.md5(url.encode()).hexdigest()[:8]}"
-        
-        # Common yt-dlp options to bypass restrictions
-        common_opts = {
-            'quiet': False,
-            'no_warnings': True,
-            'socket_timeout': 120,
-            'retries': 10,
-            'fragment_retries': 10,
-            'concurrent_fragment_downloads': 10,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'referer': 'https://www.youtube.com/',
-            'nocheckcertificate': True,
-            'outtmpl': os.path.join(DOWNLOAD_DIR, f'{safe_filename}_%(title).100s.%(ext)s'),
-            'restrictfilenames': True,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'web'],
-                    'skip': ['hls', 'dash', 'translated_subs']
-                }
-            },
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate',
-                'Sec-Fetch-Mode': 'navigate',
-            },
-            'noplaylist': True,
-            'geo_bypass': True,
-            'sleep_interval': 2,
-            'max_sleep_interval': 5,
-        }
-        
-        # Configure download options based on quality
-        if quality == 'audio':
-            ydl_opts = {
-                **common_opts,
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            }
+
+        # Direct delivery: hand the browser the media URL when it can fetch it itself
+        delivery_info = {}
+        if delivery != 'proxy':
+            try:
+                resolution = resolve_direct_delivery(url, quality, audio_format, client_ip)
+            except Exception as e:
+                resolution = {'fallback': f'direct URL resolution failed: {e}'}
+            if 'fallback' not in resolution:
+                return direct_delivery_response(resolution, delivery)
+            logger.info(f"Direct delivery unavailable ({resolution['fallback']}), proxying")
+            delivery_info = {'delivery': 'proxy', 'direct_unavailable': resolution['fallback']}
+
+        # Identical concurrent requests share one download
+        job, created = _attach_or_create_job(url, quality, client_ip, audio_format)
+        if created:
+            job_journal.record_created(job)
+            try:
+                download_scheduler.submit(job, _estimate_download_size(url, quality))
+            except DownloadJobError as e:
+                _release_job_key(job)
+                job.fail(str(e), e.status)
+                job_journal.record_outcome(job)
+                response = jsonify({'error': str(e)})
+                if e.status == 429:
+                    response.headers['Retry-After'] = str(int(download_scheduler.avg_duration))
+                return response, e.status
         else:
-            # Extract resolution number (e.g., '1080p' -> '1080')
-            resolution = quality.replace('p', '') if quality else '720'
-            
-            # Simplified format selector for better compatibility and speed
-            ydl_opts = {
-                **common_opts,
-                'format': f'best[height<={resolution}]',  # Simpler format selection
-                'merge_output_format': 'mp4',
-            }
-        
-        # Download the video
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            
-            # Handle audio conversion
-            if quality == 'audio':
-                filename = filename.rsplit('.', 1)[0] + '.mp3'
-            
-            # Check file exists and size
-            if os.path.exists(filename):
-                filesize = os.path.getsize(filename)
-                if filesize > MAX_FILESIZE:
-                    os.remove(filename)
-                    logger.warning(f"File exceeds max size: {filesize} bytes")
-                    return jsonify({'error': 'File size exceeds maximum limit (500MB)'}), 413
-            else:
-                return jsonify({'error': 'Download completed but file not found'}), 500
-            
-            logger.info(f"Download completed: {os.path.basename(filename)} ({filesize} bytes)")
-            
+            logger.info(f"Attached to running download job {job.id}")
+
+        # Async mode: return immediately, progress is streamed from /api/jobs/<id>/events
+        if data.get('async'):
+            snapshot = job.snapshot()
             return jsonify({
                 'success': True,
-                'message': 'Video downloaded successfully',
-                'filename': os.path.basename(filename),
-                'title': sanitize_text(info.get('title', 'Unknown')),
-                'filesize': filesize
-            })
-            
-    except yt_dlp.utils.DownloadError as e:
-        error_msg = str(e)
-        logger.exception(f"Download error: {error_msg}")
-        
-        # Provide more helpful error messages
-        if '403' in error_msg or 'Forbidden' in error_msg:
-            error_msg = "Access denied. This video may be restricted, age-restricted, or require sign-in. Try a different video or quality."
-        elif 'Private video' in error_msg:
-            error_msg = "This is a private video and cannot be downloaded."
-        elif 'Video unavailable' in error_msg:
-            error_msg = "Video is unavailable or has been removed."
-        elif 'sign in' in error_msg.lower():
-            error_msg = "This video requires authentication. Try a public video instead."
-            
-        return jsonify({'error': f'Download failed: {error_msg}'}), 400
+                'job_id': job.id,
+                'status': snapshot['status'],
+                'queue': snapshot.get('queue'),
+                'status_url': f'/api/jobs/{job.id}',
+                'events_url': f'/api/jobs/{job.id}/events',
+                'stream_url': f'/api/jobs/{job.id}/file',
+                'attached': not created,
+                **delivery_info
+            }), 202
+
+        # The scheduler has admitted the job; don't hold an expensive slot while it runs
+        leave_concurrency_limit()
+        job.wait()
+        if job.status == 'error':
+            return jsonify({'error': job.error}), job.http_status
+        return jsonify({**job.result, 'job_id': job.id, **delivery_info})
+
     except Exception as e:
         logger.exception(f"Unexpected error in download_video: {e}")
         return jsonify({'error': 'Download failed. Please try again or use a different video.'}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Return a snapshot of a download job"""
+    job = _get_job(job_id)
+    if job is None:
+        node = cluster.node_for_tag(job_id)  # job created by another cluster node
+        if node:
+            return cluster.proxy_get(node)
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Stream download progress as Server-Sent Events"""
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # disable proxy buffering (nginx, Render)
+    }
+
+    job = _get_job(job_id)
+    if job is None:
+        node = cluster.node_for_tag(job_id)  # job created by another cluster node
+        if not node:
+            return jsonify({'error': 'Job not found'}), 404
+        # A relayed stream holds a thread here too: same cap as local streams
+        if not sse_stream_slots.acquire(blocking=False):
+            return Response(f"retry: {SSE_RETRY_MS * 5}\n\n", mimetype='text/event-stream', headers=headers)
+        return cluster.proxy_get(node, slot=sse_stream_slots)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '0')
+    try:
+        last_seq = int(last_event_id)
+    except ValueError:
+        last_seq = 0
+    # An ID from ahead of the job came from before a restart (recovered jobs
+    # count events from zero again): replay everything instead of waiting
+    if last_seq > job.seq:
+        last_seq = 0
+
+    # Too many open streams: answer with the current state and a longer retry
+    # instead of tying up another worker thread.
+    if not sse_stream_slots.acquire(blocking=False):
+        snapshot = job.snapshot()
+        body = f"retry: {SSE_RETRY_MS * 5}\n\n" + _format_sse(_sse_event_name(snapshot), snapshot, job.seq)
+        return Response(body, mimetype='text/event-stream', headers=headers)
+
+    response = Response(_job_event_stream(job, last_seq), mimetype='text/event-stream', headers=headers)
+    response.call_on_close(sse_stream_slots.release)
+    return response
+
+@app.route('/api/jobs/<job_id>/file', methods=['GET'])
+def job_file(job_id):
+    """Serve a download's file, tailing it while it is still being written"""
+    job = _get_job(job_id)
+    if job is None:
+        node = cluster.node_for_tag(job_id)  # job created by another cluster node
+        if not node:
+            return jsonify({'error': 'Job not found'}), 404
+        # A relayed tail holds a thread here too: same cap as local readers
+        if not progressive_reader_slots.acquire(blocking=False):
+            response = jsonify({'error': 'Too many progressive downloads in progress. Please retry shortly.'})
+            response.headers['Retry-After'] = str(PROGRESSIVE_START_TIMEOUT)
+            return response, 503
+        return cluster.proxy_get(node, lane='bulk', slot=progressive_reader_slots)
+
+    with job.cond:
+        # Wait for the format decision and, if possible, the first progress
+        # report so the final size can be advertised
+        job.cond.wait_for(lambda: job.is_terminal or job.progressive is False
+                          or (job.progressive and (job.final_size or job.write_path)),
+                          PROGRESSIVE_START_TIMEOUT)
+        status, progressive, name, size = job.status, job.progressive, job.download_name, job.final_size
+    if status == 'error':
+        return jsonify({'error': job.error}), job.http_status
+    if status == 'finished':
+        return redirect(f"/api/download-file/{quote(job.result['filename'])}", code=303)
+    if not progressive:
+        message = ('Download has not started yet' if progressive is None
+                   else 'This format can only be served once the download has finished')
+        response = jsonify({'error': message, 'status_url': f'/api/jobs/{job.id}'})
+        response.headers['Retry-After'] = str(PROGRESSIVE_START_TIMEOUT)
+        return response, 409
+
+    if not progressive_reader_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many progressive downloads in progress. Please retry shortly.'})
+        response.headers['Retry-After'] = str(PROGRESSIVE_START_TIMEOUT)
+        return response, 503
+
+    headers = {
+        'Content-Disposition': f"attachment; filename=\"{sanitize_filename(name)}\"",
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    }
+    if size:
+        headers['Content-Length'] = str(size)
+    body = egress_shaper.shape(_tail_job_file(job), get_client_ip(), 'bulk')
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    response = Response(body, mimetype=mimetype, headers=headers)
+    response.call_on_close(progressive_reader_slots.release)
+    g.egress_shaped = True
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Runtime metrics for downloads and egress"""
+    return jsonify({
+        'downloads': download_scheduler.stats(),
+        'egress': egress_shaper.stats(),
+        'ydl_pools': {name: pool.stats() for name, pool in ydl_pools.items()},
+        'dns_cache': dns_cache.stats(),
+        'negative_cache': negative_cache.stats(),
+        'cache': cache_revalidator.stats(),
+        'concurrency': {name: limiter.stats() for name, limiter in concurrency_limiters.items()},
+        'cluster': cluster.stats(),
+        'journal': job_journal.stats(),
+    })
+
 @app.route('/api/download-file/<filename>', methods=['GET'])
 def download_file(filename):
     """Serve the downloaded file"""
@@ -664,8 +3571,16 @@ def download_file(filename):
         
         if os.path.exists(file_path) and os.path.isfile(file_path):
             logger.info(f"Serving file: {safe_filename}")
-            return send_file(file_path, as_attachment=True, download_name=safe_filename)
+            response = send_file(file_path, as_attachment=True, download_name=safe_filename)
+            # Throttle the body (after Range handling) through the egress shaper
+            lane = egress_shaper.lane_for(os.path.getsize(file_path))
+            response.response = egress_shaper.shape(response.response, get_client_ip(), lane)
+            g.egress_shaped = True
+            return response
         else:
+            node = cluster.node_for_tag(safe_filename)  # downloaded by another cluster node
+            if node:
+                return cluster.proxy_get(node, lane='bulk')
             logger.warning(f"File not found: {safe_filename}")
             return jsonify({'error': 'File not found'}), 404
     except Exception as e:
@@ -752,18 +3667,26 @@ if __name__ == '__main__':
     print("🚀 iwtbg API Server Starting...")
     print("=" * 60)
     print(f"📁 Download directory: {DOWNLOAD_DIR}")
-    print(f"🌐 Server running on: http://localhost:5000")
+    print(f"🌐 Server running on: http://localhost:{os.environ.get('PORT', 5000)}")
     print(f"📊 Max file size: {MAX_FILESIZE / (1024*1024*1024):.0f}GB")
     print("=" * 60)
     print("\nAvailable endpoints:")
     print("  GET  /                 - Frontend website")
     print("  GET  /api              - API status")
     print("  POST /api/analyze      - Analyze video URL")
+    print("  GET  /api/analyze/<analysis_id> - Formats for a lite analysis")
     print("  POST /api/formats      - Get available formats")
     print("  POST /api/download     - Download video")
+    print("  GET  /api/jobs/<job_id>  - Download job status")
+    print("  GET  /api/jobs/<job_id>/events - Live download progress (SSE)")
+    print("  GET  /api/jobs/<job_id>/file - Download file, streamed while in progress")
     print("  GET  /api/download-file/<filename> - Serve downloaded file")
+    print("  GET  /api/metrics      - Queue and egress metrics")
     print("=" * 60)
+    if cluster.enabled:
+        print(f"🔗 Cluster node {cluster.self_node} of {len(cluster.nodes)}")
     print("\n⚠️  Development Server - Use server_production.py for production")
+    warm_ydl_pools()
     print("Press Ctrl+C to stop the server\n")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -4,10 +4,13 @@ Production server for Video Downloader
 Uses Waitress WSGI server instead of Flask development server
 """
 
-from waitress import serve
-from server import app
+from waitress import create_server
+from server import (app, warm_ydl_pools, cluster, DOWNLOAD_DIR, recover_jobs,
+                    drain_and_checkpoint, SHUTDOWN_DRAIN_TIMEOUT, WAITRESS_THREADS)
 import os
+import signal
 import sys
+import threading
 
 if __name__ == '__main__':
     # Get port from environment variable (for deployment platforms like Render)
@@ -22,30 +25,65 @@ if __name__ == '__main__':
     print(f"🔍 Python version: {sys.version}")
     print(f"🔍 Working directory: {os.getcwd()}")
     
-    # Get download directory
-    DOWNLOAD_DIR = os.path.join(os.getcwd(), 'downloads')
-    
-    # Create downloads directory if it doesn't exist
+    # Create downloads directory (DOWNLOAD_DIR, default ./downloads) if it doesn't exist
     if not os.path.exists(DOWNLOAD_DIR):
         os.makedirs(DOWNLOAD_DIR)
         print(f"📁 Created download directory: {DOWNLOAD_DIR}")
     else:
         print(f"📁 Download directory exists: {DOWNLOAD_DIR}")
     
+    if cluster.enabled:
+        print(f"🔗 Cluster node {cluster.self_node} ({cluster.tag.rstrip('-')}) of {len(cluster.nodes)}: {', '.join(cluster.nodes)}")
+    
     print("=" * 60)
     print("\n🌐 Available endpoints:")
     print("  GET  /                 - Frontend website")
     print("  GET  /api              - API status")
     print("  POST /api/analyze      - Analyze video URL")
+    print("  GET  /api/analyze/<analysis_id> - Formats for a lite analysis")
     print("  POST /api/formats      - Get available formats")
     print("  POST /api/download     - Download video")
+    print("  GET  /api/jobs/<job_id>/events - Live download progress (SSE)")
+    print("  GET  /api/jobs/<job_id>/file - Download file, streamed while in progress")
     print("=" * 60)
     print(f"\n✨ Starting Waitress server on 0.0.0.0:{port}")
     print("=" * 60)
     
+    # Enough threads that the adaptive limiter, not Waitress's queue, sheds load
+    threads = WAITRESS_THREADS
+
+    # Pre-create pooled yt-dlp instances while the server starts
+    warm_ydl_pools()
+
+    # Resume or clean up jobs left unfinished by the previous process
+    recovered = recover_jobs()
+    print(f"📒 Job journal: {recovered['restored']} restored, {recovered['resumed']} resumed, "
+          f"{recovered['abandoned']} abandoned")
+
+    shutting_down = threading.Event()
+
+    def shutdown():
+        # Refuse new downloads, let running ones finish, checkpoint the rest
+        unfinished = drain_and_checkpoint(SHUTDOWN_DRAIN_TIMEOUT)
+        print(f"👋 Shut down with {unfinished} job(s) checkpointed for the next start")
+        sys.stdout.flush()
+        os._exit(0)  # download worker threads would otherwise block interpreter exit
+
+    def on_sigterm(signum, frame):
+        if shutting_down.is_set():
+            os._exit(1)  # second signal: give up on draining
+        shutting_down.set()
+        print(f"\n🛑 Received signal {signum}, draining for up to {SHUTDOWN_DRAIN_TIMEOUT}s...")
+        threading.Thread(target=shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    signal.signal(signal.SIGINT, on_sigterm)
+    
     # Run production server with explicit binding
     try:
-        serve(app, host='0.0.0.0', port=port, threads=4, _quiet=False)
+        server = create_server(app, host='0.0.0.0', port=port, threads=threads)
+        server.print_listen('Serving on http://{}:{}')
+        server.run()
     except Exception as e:
         print(f"❌ Error starting server: {e}")
         sys.exit(1)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Table-driven check of how failed extractions are classified for the negative cache
+"""
+import concurrent.futures
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import classify_extraction_error
+
+CASES = [
+    ('ERROR: [youtube] abc: Private video. Sign in if you\'ve been granted access', 'permanent'),
+    ('ERROR: [youtube] abc: Video unavailable. This video has been removed by the uploader', 'permanent'),
+    ('ERROR: [generic] Unable to download webpage: HTTP Error 404: Not Found', 'permanent'),
+    ('ERROR: [generic] Unable to download webpage: HTTP Error 410: Gone', 'permanent'),
+    ('ERROR: Unsupported URL: https://example.com/', 'permanent'),
+    ('ERROR: [youtube] abc: Sign in to confirm you\'re not a bot', 'transient'),
+    ('ERROR: [generic] Unable to download webpage: HTTP Error 503: Service Unavailable', 'transient'),
+    ('ERROR: [generic] Unable to download webpage: <urlopen error [Errno 111] Connection refused>', 'transient'),
+    ('ERROR: [youtube] abc: HTTP Error 429: Too Many Requests', 'transient'),
+    ('Something nobody has seen before', 'transient'),
+    (TimeoutError('yt-dlp extract_info timed out after 30s'), 'transient'),
+    (concurrent.futures.TimeoutError(), 'transient'),
+]
+
+
+def test_classify_extraction_error():
+    for error, expected in CASES:
+        got = classify_extraction_error(error if isinstance(error, Exception) else Exception(error))
+        assert got == expected, f"{error!r}: expected {expected}, got {got}"
+
+
+if __name__ == '__main__':
+    test_classify_extraction_error()
+    print(f"✓ {len(CASES)} error classification cases passed")